@@ -0,0 +1,36 @@
+"""
+Benchmark the pipeline on synthetic cohorts.
+
+Each step of the pipeline is timed and memory-profiled on synthetic 
+data with the given numbers of subjects and parameters, e.g. 
+`python benchmark.py --subjects 8 100 1000 --parameters 100 1000`. 
+Results are saved in build/Benchmarks/<commit>.csv. Use --compare to 
+compare them with the results of an earlier commit, or --imports to 
+check the import time of each stage against a budget.
+"""
+
+import sys
+import argparse
+
+from stages import bench
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('stages', nargs='*', help="Stages to benchmark (data, desc, stats, plot)")
+parser.add_argument('--subjects', type=int, nargs='+', default=[8, 100, 1000], help="Numbers of subjects")
+parser.add_argument('--parameters', type=int, nargs='+', default=[100, 500], help="Numbers of parameters")
+parser.add_argument('--timeout', type=float, default=600, help="Maximum time per step (sec)")
+parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic data")
+parser.add_argument('--compare', metavar='COMMIT', help="Compare with the results of this commit instead of running")
+parser.add_argument('--imports', action='store_true', help="Report the import time of each stage instead of running")
+parser.add_argument('--budget', type=float, default=bench.IMPORT_BUDGET, help="Maximum import time per stage (sec)")
+args = parser.parse_args()
+
+if args.imports:
+    times = bench.import_times(args.stages or None, args.budget)
+    print(times.to_string())
+    if not times['within budget'].all():
+        sys.exit(f"Import time over budget ({args.budget} s)")
+elif args.compare:
+    print(bench.compare(args.compare).to_string())
+else:
+    bench.run(args.subjects, args.parameters, args.stages or None, args.timeout, args.seed)
@@ -1,12 +1,25 @@
 """
 Main script to reproduce the results in the paper.
+
+Only the steps whose code or input files have changed since the last 
+run are executed. Use --force to rebuild everything, or list stages to 
+restrict the run, e.g. `python run.py desc stats`. With --offline the 
+input data are taken from the local download cache only.
 """
 
-from stages import setup, data, desc, stats, plot, report
+import os
+import argparse
+
+from stages import pipeline
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('stages', nargs='*', help="Stages to run (data, desc, stats, cluster, plot, report)")
+parser.add_argument('--force', action='store_true', help="Run all steps even if up to date")
+parser.add_argument('--offline', action='store_true', help="Use cached downloads only")
+parser.add_argument('--workers', type=int, help="Processes to render the figures (default: number of cores)")
+args = parser.parse_args()
+
+if args.offline:
+    os.environ['TRISTAN_OFFLINE'] = '1'
 
-setup.main()    # Build folders
-data.main()     # Format data
-desc.main()     # Create tables
-stats.main()    # Statistical analysis
-plot.main()     # Create plots
-report.main()   # Create report
\ No newline at end of file
+pipeline.run(args.stages or None, force=args.force, workers=args.workers)
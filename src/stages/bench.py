@@ -0,0 +1,423 @@
+import os
+import io
+import sys
+import json
+import shutil
+import zipfile
+import tempfile
+import platform
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+from stages import lazy, data, pipeline, plot, report
+
+pd = lazy.module('pandas')
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+benchpath = os.path.join(root, 'build', 'Benchmarks')
+
+# Template archives for the synthetic cohorts
+TEMPLATES = [filename for _, filename in data.DOWNLOADS]
+RESULTS = 'tristan_humans_healthy_rifampicin_all_results.dmr.zip'
+METADATA = os.path.join('_static', 'MRI_metadata.dmr.zip')
+
+# Steps that are not benchmarked: the download needs network access and
+# the report needs a LaTeX installation.
+EXCLUDE = [data.download, report.main]
+
+# Code run in a fresh process for each step
+RUNNER = """
+import json, resource, sys, time
+import matplotlib
+matplotlib.use('Agg')
+from stages import lazy, {module}
+# Load the heavy dependencies before the clock starts: the import time
+# is reported separately by import_times().
+lazy.preload([m for n, m in list(sys.modules.items()) if n.startswith('stages.')])
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+t = time.perf_counter()
+{call}
+t = time.perf_counter() - t
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{'seconds': t, 'peak_mb': peak/1024, 'step_mb': (peak-rss)/1024}}))
+"""
+
+
+def steps():
+    """
+    Steps of the pipeline in execution order, as a list of dicts with
+    the name of the step, the code that runs it and its input files.
+    The plot steps are replaced by the individual figures.
+    """
+    todo = []
+    for node in pipeline.NODES:
+        for func in node.get('run', []):
+            if func in EXCLUDE:
+                continue
+            module = func.__module__.split('.')[-1]
+            if module == 'plot':
+                continue
+            todo.append({
+                'name': f"{module}.{func.__name__}",
+                'module': module,
+                'call': f"{module}.{func.__name__}()",
+                'inputs': node['inputs'],
+            })
+    for name in plot.FIGURES:
+        todo.append({
+            'name': f"plot.{name}",
+            'module': 'plot',
+            'call': f"plot.render([{name!r}], workers=1)",
+            'inputs': [],
+        })
+    return todo
+
+
+def _read_zip(file):
+    with zipfile.ZipFile(file) as z:
+        return {
+            member: pd.read_csv(z.open(member), keep_default_na=False, dtype=str)
+            for member in z.namelist()
+        }
+
+
+def _write_zip(file, tables):
+    with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as z:
+        for member, df in tables.items():
+            buffer = io.StringIO()
+            df.to_csv(buffer, index=False)
+            z.writestr(member, buffer.getvalue())
+
+
+def _rows(df, key, labels, names):
+    # Rows of df with df[key]==labels[i], renamed as names[i], for all i
+    groups = df.groupby(key, sort=False).indices
+    idx = [groups.get(label, np.array([], dtype=int)) for label in labels]
+    out = df.iloc[np.concatenate(idx)].copy()
+    out[key] = np.repeat(names, [len(i) for i in idx])
+    return out
+
+
+def synthesize(folder, subjects=10, parameters=100, seed=0):
+    """
+    Write a synthetic cohort in the layout of the downloaded data.
+
+    The synthetic data are scaled up (or down) from the downloaded
+    archives in build/Data. Extra subjects are copies of the study
+    subjects, and extra parameters copies of the MRI parameters, with
+    10% random variation on the values.
+
+    Args:
+        folder (str): root folder of the copy of the pipeline.
+        subjects (int): number of study subjects.
+        parameters (int): approximate number of parameters in the
+          combined data. No parameters are removed if this is less
+          than the number of parameters in the study data.
+        seed (int): seed of the random variation.
+    """
+    rng = np.random.default_rng(seed)
+    templates = {f: _read_zip(os.path.join(root, 'build', 'Data', f)) for f in TEMPLATES}
+    meta = _read_zip(os.path.join(root, METADATA))
+
+    # Synthetic subjects, each a copy of a study subject
+    study = sorted(templates[RESULTS]['pars.csv'].subject.unique())
+    tmpl_subj = [study[i % len(study)] for i in range(subjects)]
+    new_subj = [s if i < len(study) else f"SYN-{i:05d}" for i, s in enumerate(tmpl_subj)]
+
+    # Synthetic MRI parameters, each a copy of a numerical MRI parameter
+    dictionary = meta['data.csv']
+    nparams = len(set().union(*[t['data.csv'].parameter for t in templates.values()]))
+    mri = dictionary[
+        dictionary.group.isin(['MRI - liver', 'MRI - aorta'])
+        & (dictionary.value_map == 'NaN')
+    ].parameter.values
+    extra = max(0, parameters - nparams)
+    tmpl_par = [mri[j % len(mri)] for j in range(extra)]
+    new_par = [f"{p}_syn{j}" for j, p in enumerate(tmpl_par)]
+    extra_meta = _rows(dictionary, 'parameter', tmpl_par, new_par)
+    extra_meta['label'] = [f"{l}#{j}" for j, l in enumerate(extra_meta.label)]
+    meta['data.csv'] = pd.concat([dictionary, extra_meta])
+    _write_zip(os.path.join(folder, METADATA), meta)
+
+    for filename, tables in templates.items():
+        is_mri = 'MRI - liver' in set(tables['data.csv'].group)
+        if is_mri:
+            tables['data.csv'] = meta['data.csv']
+        categorical = set(tables['data.csv'].parameter[tables['data.csv'].value_map != 'NaN'])
+        for member in ['pars.csv', 'sdev.csv']:
+            if member not in tables:
+                continue
+            df = tables[member]
+            if is_mri:
+                df = pd.concat([df, _rows(df, 'parameter', tmpl_par, new_par)])
+            others = df[~df.subject.isin(study)]
+            df = pd.concat([_rows(df, 'subject', tmpl_subj, new_subj), others])
+
+            # Random variation on synthetic values
+            vary = (
+                df.subject.str.startswith('SYN-') | df.parameter.isin(new_par)
+            ) & ~df.parameter.isin(categorical)
+            values = df.value.values.astype(float)
+            if member == 'pars.csv':
+                values[vary] *= 1 + 0.1 * rng.standard_normal(vary.sum())
+            df['value'] = values
+            tables[member] = df
+        _write_zip(os.path.join(folder, 'build', 'Data', filename), tables)
+
+
+def _workspace():
+    # Copy of the code in a temporary folder
+    folder = tempfile.mkdtemp(prefix='tristan-bench-')
+    shutil.copytree(
+        os.path.join(root, 'src', 'stages'),
+        os.path.join(folder, 'src', 'stages'),
+        ignore=shutil.ignore_patterns('__pycache__'),
+    )
+    os.makedirs(os.path.join(folder, '_static'))
+    for sub in ['Data', 'Tables', 'Figs', 'Store']:
+        os.makedirs(os.path.join(folder, 'build', sub))
+    return folder
+
+
+def _run_step(folder, step, timeout):
+    for file in step['inputs']:
+        if not os.path.exists(os.path.join(folder, file)):
+            return {'status': 'skipped', 'error': f'{file} missing'}
+    code = RUNNER.format(module=step['module'], call=step['call'])
+    try:
+        proc = subprocess.run(
+            [sys.executable, '-c', code],
+            cwd=os.path.join(folder, 'src'),
+            capture_output=True, text=True, timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return {'status': 'timeout', 'error': f'more than {timeout} s'}
+    if proc.returncode != 0:
+        lines = proc.stderr.strip().splitlines()
+        error = lines[-1] if lines else f'exit code {proc.returncode}'
+        return {'status': 'error', 'error': error}
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    return {'status': 'ok', **result}
+
+
+def commit(rev=None):
+    """
+    Short hash of a commit.
+
+    Args:
+        rev (str, optional): any git revision, e.g. 'HEAD~1' or a tag. 
+          Defaults to the current commit, with suffix -dirty if the 
+          code has uncommitted changes.
+    """
+    git = lambda *args: subprocess.run(
+        ['git', *args], cwd=root, capture_output=True, text=True,
+    ).stdout.strip()
+    try:
+        short = git('rev-parse', '--short', '--verify', '--quiet', 
+                    (rev or 'HEAD') + '^{commit}')
+        dirty = git('status', '--porcelain', '--', 'src') if rev is None else ''
+    except FileNotFoundError:
+        return 'unknown'
+    if not short:
+        return 'unknown'
+    return short + '-dirty' if dirty else short
+
+
+# Maximum time to import a stage, in seconds
+IMPORT_BUDGET = 1.0
+
+
+def _import_time(module):
+    # Import a module in a fresh process and parse the report of 
+    # python -X importtime: (self, cumulative, name) per module in us
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+        cwd=os.path.join(root, 'src'), capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise ImportError(proc.stderr.strip().splitlines()[-1])
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(own), int(cumulative), name.rstrip()))
+    # Modules are listed after their imports, with top-level imports 
+    # indented by one space. Drop those of the interpreter startup.
+    start = max(
+        i + 1 for i, (_, _, name) in enumerate(rows)
+        if name.startswith(' ') and not name.startswith('  ')
+        and not name.strip().startswith(module.split('.')[0])
+    )
+    return rows[start:]
+
+
+def import_times(modules=None, budget=IMPORT_BUDGET):
+    """
+    Time the import of each stage in a fresh process.
+
+    Args:
+        modules (list, optional): stages to import, e.g. ['data', 'desc'].
+          Defaults to all stages and the pipeline.
+        budget (float, optional): maximum import time in seconds. 
+          Defaults to IMPORT_BUDGET.
+
+    Returns:
+        pd.DataFrame: import time of each stage, whether it is within 
+          the budget, and the heaviest third-party packages it imports.
+    """
+    if modules is None:
+        modules = [
+            'setup', 'store', 'dataset', 'data', 'calc', 'desc', 'stats', 
+            'cluster', 'plot', 'report', 'pipeline',
+        ]
+    out = []
+    for module in modules:
+        rows = _import_time('stages.' + module)
+        total = sum(
+            cumulative for _, cumulative, name in rows 
+            if not name.startswith('  ')
+        )
+        # Third-party packages, i.e. top-level names outside the 
+        # standard library and the stages package
+        packages = {
+            name.strip(): cumulative for _, cumulative, name in rows
+            if '.' not in name.strip() and not name.strip().startswith('_')
+            and name.strip() not in sys.stdlib_module_names
+            and name.strip() != 'stages'
+        }
+        heaviest = sorted(packages.items(), key=lambda kv: -kv[1])[:3]
+        heaviest = [(n, t) for n, t in heaviest if t >= 1000]
+        out.append({
+            'stage': module,
+            'seconds': total / 1e6,
+            'within budget': total / 1e6 <= budget,
+            'heaviest imports': ', '.join(f"{n} ({t/1e6:.2f} s)" for n, t in heaviest),
+        })
+    return pd.DataFrame(out).set_index('stage')
+
+
+def resultsfile(name=None):
+    return os.path.join(benchpath, (name or commit()) + '.csv')
+
+
+def run(subjects=None, parameters=None, stages=None, timeout=600, seed=0):
+    """
+    Time and memory-profile each step of the pipeline on synthetic
+    cohorts of increasing size.
+
+    Each step runs in a new process on a copy of the code, in the order
+    of the pipeline. Steps whose inputs are missing because an earlier
+    step failed are skipped. A step that times out is not run again on
+    larger cohorts.
+
+    Results are saved in build/Benchmarks/<commit>.csv, replacing
+    earlier results for the same commit, cohort sizes and steps.
+
+    Args:
+        subjects (list, optional): numbers of subjects. Defaults to 
+          [8, 100, 1000].
+        parameters (list, optional): numbers of parameters. Defaults 
+          to [100, 500].
+        stages (list, optional): only benchmark steps of these stages,
+          e.g. ['desc', 'stats']. Defaults to all stages.
+        timeout (float): maximum time per step in seconds.
+        seed (int): seed for the synthetic data.
+
+    Returns:
+        pd.DataFrame: the results of this run.
+    """
+    if subjects is None:
+        subjects = [8, 100, 1000]
+    if parameters is None:
+        parameters = [100, 500]
+    todo = [s for s in steps() if stages is None or s['module'] in stages]
+    info = {
+        'commit': commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'machine': f"{platform.node()} ({platform.machine()}, {os.cpu_count()} cpu)",
+    }
+    timeouts = {}
+    rows = []
+    for nsubj in sorted(subjects):
+        for npar in sorted(parameters):
+            print(f"Cohort with {nsubj} subjects and {npar} parameters")
+            folder = _workspace()
+            try:
+                synthesize(folder, nsubj, npar, seed)
+            except Exception as e:
+                shutil.rmtree(folder, ignore_errors=True)
+                rows.append({
+                    **info, 'subjects': nsubj, 'parameters': npar,
+                    'step': 'synthesize', 'status': 'error', 'error': repr(e),
+                })
+                continue
+            for step in todo:
+                if any(nsubj >= n and npar >= p for n, p in timeouts.get(step['name'], [])):
+                    result = {'status': 'skipped', 'error': 'timed out on a smaller cohort'}
+                else:
+                    result = _run_step(folder, step, timeout)
+                if result['status'] == 'timeout':
+                    timeouts.setdefault(step['name'], []).append((nsubj, npar))
+                print(f"  {step['name']}: {result['status']} {result.get('seconds', '')}")
+                rows.append({
+                    **info, 'subjects': nsubj, 'parameters': npar,
+                    'step': step['name'], **result,
+                })
+            shutil.rmtree(folder, ignore_errors=True)
+
+    results = pd.DataFrame(rows)
+    save(results)
+    return results
+
+
+def save(results):
+    os.makedirs(benchpath, exist_ok=True)
+    file = resultsfile(results['commit'].iloc[0])
+    if os.path.exists(file):
+        old = pd.read_csv(file)
+        keys = ['subjects', 'parameters', 'step']
+        new = pd.MultiIndex.from_frame(results[keys])
+        old = old[~pd.MultiIndex.from_frame(old[keys]).isin(new)]
+        results = pd.concat([old, results])
+    results.to_csv(file, index=False)
+
+
+def _read_results(rev=None):
+    # Results of a results file name or else of a git revision
+    file = resultsfile(rev)
+    if rev is not None and not os.path.exists(file):
+        file = resultsfile(commit(rev))
+    if not os.path.exists(file):
+        raise FileNotFoundError(
+            f"No benchmark results for {rev or commit()} in {benchpath}. "
+            "Run python benchmark.py at that commit first."
+        )
+    return pd.read_csv(file)
+
+
+def compare(reference, current=None):
+    """
+    Compare benchmark results of two commits.
+
+    Args:
+        reference (str): commit of the reference results, as any git 
+          revision (e.g. 'HEAD~1') or as the name of a results file 
+          (e.g. 'a1b2c3d-dirty').
+        current (str, optional): commit to compare, in the same form. 
+          Defaults to the current commit.
+
+    Returns:
+        pd.DataFrame: time and peak memory of both commits, and their
+          ratio (current/reference), per cohort and step.
+    """
+    keys = ['subjects', 'parameters', 'step']
+    cols = ['status', 'seconds', 'peak_mb']
+    ref = _read_results(reference).set_index(keys)[cols]
+    cur = _read_results(current).set_index(keys)[cols]
+    out = ref.join(cur, how='outer', lsuffix='_ref', rsuffix='')
+    out['time ratio'] = out['seconds'] / out['seconds_ref']
+    out['memory ratio'] = out['peak_mb'] / out['peak_mb_ref']
+    return out
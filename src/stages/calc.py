@@ -0,0 +1,543 @@
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from stages import lazy
+
+pd = lazy.module('pandas')
+integrate = lazy.module('scipy.integrate')
+special = lazy.module('scipy.special')
+stats = lazy.module('scipy.stats')
+
+
+
+def corr(x, y=None):
+    """
+    Pearson correlations between all columns of x and all columns of y.
+
+    Each pair uses the rows where both variables are available
+    (pairwise-complete), as pingouin.corr does for a single pair.
+
+    Args:
+        x (pd.DataFrame): observations (rows) by variables (columns).
+        y (pd.DataFrame, optional): second set of variables on the
+          same rows. If not provided, x is correlated with itself.
+
+    Returns:
+        dict: dataframes with the columns of x as index (X) and the
+          columns of y as columns (Y), for keys 'n', 'r', 'CI95% low',
+          'CI95% high' and 'p-unc'.
+    """
+    if y is None:
+        y = x
+    X = x.values.astype(float)
+    Y = y.values.astype(float)
+    mx = ~np.isnan(X)
+    my = ~np.isnan(Y)
+
+    # Center on the column means to limit round-off in the sums
+    with np.errstate(invalid='ignore', divide='ignore'):
+        X = X - np.nansum(X, axis=0) / mx.sum(axis=0)
+        Y = Y - np.nansum(Y, axis=0) / my.sum(axis=0)
+    X = np.where(mx, X, 0)
+    Y = np.where(my, Y, 0)
+    mx = mx.astype(float)
+    my = my.astype(float)
+
+    # Sums over the pairwise-complete rows
+    n = mx.T @ my
+    sx = X.T @ my
+    sy = mx.T @ Y
+    sxx = (X**2).T @ my
+    syy = mx.T @ (Y**2)
+    sxy = X.T @ Y
+
+    r, p = _pearson(n, sx, sy, sxx, syy, sxy)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+
+        # Confidence interval via Fisher's z-transform, rounded to 2
+        # decimals as in pingouin
+        z = np.arctanh(r)
+        dz = stats.norm.ppf(0.975) / np.sqrt(n-3)
+        ci_low = np.where(np.abs(r)==1, r, np.round(np.tanh(z - dz), 2))
+        ci_high = np.where(np.abs(r)==1, r, np.round(np.tanh(z + dz), 2))
+
+    frame = lambda v: pd.DataFrame(
+        v,
+        index=pd.Index(x.columns, name='X'),
+        columns=pd.Index(y.columns, name='Y'),
+    )
+    return {
+        'n': frame(n.astype(int)),
+        'r': frame(r),
+        'CI95% low': frame(ci_low),
+        'CI95% high': frame(ci_high),
+        'p-unc': frame(p),
+    }
+
+
+def _pearson(n, sx, sy, sxx, syy, sxy):
+    # Correlation coefficients and p-values from the sums over the 
+    # pairwise-complete rows
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cxx = sxx - sx**2/n
+        cyy = syy - sy**2/n
+        cxy = sxy - sx*sy/n
+
+        # Constant variables have no correlation
+        cxx[cxx <= 1e-10*sxx] = np.nan
+        cyy[cyy <= 1e-10*syy] = np.nan
+        r = np.clip(cxy / np.sqrt(cxx*cyy), -1, 1)
+        r[n < 2] = np.nan
+
+        # Two-sided p-value from the t-distribution with n-2 dof
+        p = special.betainc((n-2)/2, 0.5, np.clip(1-r**2, 0, 1))
+        p[n == 2] = 1.0
+        p[np.isnan(r)] = np.nan
+    return r, p
+
+
+def paired_ttest(x, y, r=0.707):
+    """
+    Paired t-tests between the columns of x and y, all columns at once.
+
+    Subjects with a missing value in either x or y are excluded for that
+    column (listwise deletion), as in pingouin.pairwise_tests.
+
+    Args:
+        x (pd.DataFrame): subjects (rows) by parameters (columns) for 
+          the first condition.
+        y (pd.DataFrame): same for the second condition.
+        r (float, optional): Cauchy scale factor of the JZS prior for 
+          the Bayes factor. Defaults to 0.707.
+
+    Returns:
+        pd.DataFrame: one row per parameter with columns 'n', 'T', 
+          'dof', 'p-unc', 'BF10' and 'odds-ratio'.
+    """
+    y = y.reindex(index=x.index, columns=x.columns)
+    X = x.values.astype(float)
+    Y = y.values.astype(float)
+    mask = ~np.isnan(X) & ~np.isnan(Y)
+    X = np.where(mask, X, np.nan)
+    Y = np.where(mask, Y, np.nan)
+    n = mask.sum(axis=0)
+    dof = n - 1.0
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+
+        # T-statistic of the differences
+        D = X - Y
+        mean = np.nanmean(D, axis=0)
+        se = np.nanstd(D, axis=0, ddof=1) / np.sqrt(n)
+        T = mean / se
+        p = 2 * stats.t.sf(np.abs(T), dof)
+
+        # Cohen d-avg converted to an odds ratio
+        d = np.nanmean(X, axis=0) - np.nanmean(Y, axis=0)
+        d /= np.sqrt((np.nanvar(X, axis=0, ddof=1) + np.nanvar(Y, axis=0, ddof=1)) / 2)
+        odds_ratio = np.exp(d * np.pi / np.sqrt(3))
+
+    return pd.DataFrame(
+        {
+            'n': n,
+            'T': T,
+            'dof': dof,
+            'p-unc': p,
+            'BF10': bayesfactor_ttest(T, n, r=r),
+            'odds-ratio': odds_ratio,
+        },
+        index=x.columns,
+    )
+
+
+def bayesfactor_ttest(t, n, r=0.707):
+    """
+    JZS Bayes factors of one-sample or paired t-tests for arrays of 
+    T-values and sample sizes (Rouder et al. 2009, eq. 1).
+    """
+    t = np.asarray(t, dtype=float)
+    n = np.asarray(n, dtype=float)
+    bf10 = np.full(t.shape, np.nan)
+    ok = np.isfinite(t) & (n > 1)
+    if not ok.any():
+        return bf10
+    t, n = t[ok], n[ok]
+    df = n - 1
+
+    def fun(g):
+        with np.errstate(over='ignore', under='ignore', divide='ignore', invalid='ignore'):
+            return (
+                (1 + n*g*r**2) ** (-0.5)
+                * (1 + t**2 / ((1 + n*g*r**2) * df)) ** (-(df + 1) / 2)
+                * (2*np.pi) ** (-0.5)
+                * g ** (-3.0/2)
+                * np.exp(-1 / (2*g))
+            )
+
+    integr = integrate.quad_vec(fun, 0, np.inf, epsabs=0, epsrel=1e-10)[0]
+    with np.errstate(divide='ignore'):
+        bf10[ok] = integr / (1 + t**2/df) ** (-(df + 1) / 2)
+    return bf10
+
+
+def format_bf(bf10, precision=3):
+    """
+    Format Bayes factors as strings, as in pingouin.
+    """
+    out = []
+    for bf in bf10:
+        if np.isnan(bf):
+            out.append(np.nan)
+        elif bf >= 1e4 or bf <= 1e-4:
+            out.append(np.format_float_scientific(bf, precision=precision, trim='0'))
+        else:
+            out.append(np.format_float_positional(bf, precision=precision, trim='0'))
+    return out
+
+
+def around_sig(x, n):
+    """
+    Round all elements of an array to n significant digits.
+
+    Zeros, infinities and NaN values are returned unchanged. Numbers are
+    scaled by a power of 10 so that n digits come before the decimal 
+    point, rounded to an integer and scaled back. Negative powers are 
+    applied as divisions by exact powers of 10, which gives the same 
+    result as the built-in round().
+    """
+    x = np.asarray(x, dtype=float)
+    out = x.copy()
+    ok = np.isfinite(x) & (x != 0)
+    v = x[ok]
+    decimals = n - 1 - np.floor(np.log10(np.abs(v))).astype(int)
+    with np.errstate(over='ignore', invalid='ignore'):
+        scale = 10.0 ** np.abs(decimals)
+        out[ok] = np.where(
+            decimals >= 0, 
+            np.rint(v * scale) / scale, 
+            np.rint(v / scale) * scale,
+        )
+    return out
+
+
+def format_ci(avr, err, suffix=''):
+    """
+    Format arrays of means and confidence intervals as strings 
+    'mean (ci)', all elements at once.
+    """
+    avr = np.asarray(avr, dtype=float).astype(str)
+    err = np.asarray(err, dtype=float).astype(str)
+    return np.char.add(np.char.add(avr, ' ('), np.char.add(err, ')' + suffix))
+
+
+def _resample_means(x, seed, size):
+    # Means of the columns of x over size resamples of its rows. Each
+    # resample is a row of an index matrix, converted to counts so 
+    # that the sums of all resamples are a single matrix product.
+    n = x.shape[0]
+    idx = np.random.default_rng(seed).integers(0, n, size=(size, n))
+    idx += n * np.arange(size)[:, None]
+    counts = np.bincount(idx.ravel(), minlength=size*n).reshape(size, n)
+    mask = ~np.isnan(x)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (counts @ np.where(mask, x, 0)) / (counts @ mask)
+
+
+def _quantiles(boot, q):
+    # Quantiles q (levels x columns) of each column of boot, ignoring 
+    # NaN values, with linear interpolation as in np.nanquantile.
+    boot = np.sort(boot, axis=0)
+    n = np.sum(~np.isnan(boot), axis=0)
+    pos = q * (n - 1)
+    lo = np.clip(np.floor(pos).astype(int), 0, np.maximum(n - 1, 0))
+    hi = np.clip(lo + 1, 0, np.maximum(n - 1, 0))
+    vlo = np.take_along_axis(boot, lo, axis=0)
+    vhi = np.take_along_axis(boot, hi, axis=0)
+    out = vlo + (pos - lo) * (vhi - vlo)
+    out[:, n == 0] = np.nan
+    return out
+
+
+def bootstrap_ci(x, n_resamples=10000, method='percentile', level=0.95, 
+                 seed=0, chunk=10000, workers=1):
+    """
+    Bootstrap confidence intervals of the means of all columns at once.
+
+    Rows (subjects) are resampled with replacement, the same resamples
+    for all columns. Missing values are ignored in the means. Resamples 
+    are drawn in chunks with independent seeds spawned from seed, so 
+    the result does not depend on the number of workers.
+
+    Args:
+        x (array-like): observations (rows) by variables (columns).
+        n_resamples (int, optional): number of resamples. Defaults 
+          to 10000.
+        method (str, optional): 'percentile' or 'bca' (bias-corrected
+          and accelerated). Defaults to 'percentile'.
+        level (float, optional): confidence level. Defaults to 0.95.
+        seed (int, optional): seed of the resampling. Defaults to 0.
+        chunk (int, optional): number of resamples per chunk. Defaults 
+          to 10000.
+        workers (int, optional): number of processes. Defaults to 1.
+
+    Returns:
+        tuple: arrays with the lower and upper limits per column.
+    """
+    x = np.asarray(x, dtype=float)
+    x = x[~np.all(np.isnan(x), axis=1)]
+    sizes = [min(chunk, n_resamples - i) for i in range(0, n_resamples, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = ([x]*len(sizes), seeds, sizes)
+    if workers == 1:
+        boot = np.concatenate(list(map(_resample_means, *args)))
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            boot = np.concatenate(list(pool.map(_resample_means, *args)))
+
+    alpha = (1 - level) / 2
+    z = stats.norm.ppf([alpha, 1 - alpha])[:, None]
+    if method == 'percentile':
+        q = stats.norm.cdf(z) * np.ones(x.shape[1])
+    elif method == 'bca':
+        mask = ~np.isnan(x)
+        cnt = mask.sum(axis=0)
+        total = np.nansum(x, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # Bias from the fraction of resamples below the estimate
+            valid = ~np.isnan(boot)
+            below = np.sum(boot < total/cnt, axis=0) / valid.sum(axis=0)
+            z0 = stats.norm.ppf(below)
+            # Acceleration from the jackknife (leave-one-out) means
+            jack = np.where(mask, (total - x) / (cnt - 1), np.nan)
+            d = np.nanmean(jack, axis=0) - jack
+            acc = np.nansum(d**3, axis=0) / (6 * np.nansum(d**2, axis=0)**1.5)
+            q = stats.norm.cdf(z0 + (z0 + z) / (1 - acc * (z0 + z)))
+    else:
+        raise ValueError(f"Unknown bootstrap method {method}")
+    low, high = _quantiles(boot, q)
+    return low, high
+
+
+def _flips(n, size=None, rng=None):
+    # Sign flips of n subjects: all 2**n if size is None, else size 
+    # random ones
+    if size is None:
+        bits = (np.arange(2**n)[:, None] >> np.arange(n)) & 1
+    else:
+        bits = rng.integers(0, 2, size=(size, n))
+    return 1.0 - 2.0*bits
+
+
+def permutation_ttest(x, y, n_resamples=10000, max_exact=16, seed=0, chunk=10000):
+    """
+    Paired sign-flip permutation tests between the columns of x and y,
+    all columns at once.
+
+    Under the null hypothesis the sign of each paired difference is 
+    arbitrary. The test statistic is the sum of the differences, and 
+    the two-sided p-value the fraction of sign flips with an absolute 
+    sum at least as large as observed. Missing differences are set to 
+    zero, so that they do not change the sums. The sums of all flips 
+    and parameters are a single matrix product.
+
+    Args:
+        x (pd.DataFrame): subjects (rows) by parameters (columns) for 
+          the first condition.
+        y (pd.DataFrame): same for the second condition.
+        n_resamples (int, optional): number of random flips when the 
+          test is not exact. Defaults to 10000.
+        max_exact (int, optional): all 2**n flips are enumerated if 
+          the number of subjects n is at most max_exact. Defaults to 16.
+        seed (int, optional): seed of the random flips. Defaults to 0.
+        chunk (int, optional): number of random flips per product. 
+          Defaults to 10000.
+
+    Returns:
+        np.ndarray: p-values per parameter.
+    """
+    y = y.reindex(index=x.index, columns=x.columns)
+    D = y.values.astype(float) - x.values.astype(float)
+    D = D[~np.all(np.isnan(D), axis=1)]
+    valid = ~np.isnan(D)
+    D = np.where(valid, D, 0)
+    n = D.shape[0]
+
+    # Differences within round-off of the observed sum count as equal
+    observed = np.abs(D.sum(axis=0))
+    observed -= 1e-10 * np.abs(D).sum(axis=0)
+
+    if n <= max_exact:
+        count = np.sum(np.abs(_flips(n) @ D) >= observed, axis=0)
+        p = count / 2**n
+    else:
+        rng = np.random.default_rng(seed)
+        count = np.zeros(D.shape[1])
+        for i in range(0, n_resamples, chunk):
+            flips = _flips(n, min(chunk, n_resamples - i), rng)
+            count += np.sum(np.abs(flips @ D) >= observed, axis=0)
+        # Include the observed flip so that p is never zero
+        p = (count + 1) / (n_resamples + 1)
+    p[valid.sum(axis=0) == 0] = np.nan
+    return p
+
+
+def leave_out(n, k=1):
+    """
+    All subsets of k out of n subjects, as a subsets x subjects matrix
+    with 1 for the subjects that are left out.
+    """
+    subsets = np.array(list(itertools.combinations(range(n), k)), dtype=int)
+    L = np.zeros((len(subsets), n))
+    L[np.repeat(np.arange(len(subsets)), k), subsets.ravel()] = 1
+    return L
+
+
+def leave_out_describe(x, L):
+    """
+    Mean, standard deviation and count of all columns of x, for each 
+    subset of rows left out.
+
+    The sums and sums of squares of all rows are computed once, and 
+    the contributions of the rows left out are subtracted with a 
+    single matrix product per sum. 
+
+    Args:
+        x (np.ndarray): subjects (rows) by parameters (columns), with 
+          NaN for missing values.
+        L (np.ndarray): subsets x subjects matrix of the subjects left
+          out, as returned by leave_out().
+
+    Returns:
+        tuple: arrays (subsets x parameters) of the means, standard 
+          deviations and counts.
+    """
+    mask = ~np.isnan(x)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Center on the column means to limit round-off in the sums
+        center = np.nansum(x, axis=0) / mask.sum(axis=0)
+        x = np.where(mask, x - center, 0)
+        n = mask.sum(axis=0) - L @ mask
+        s1 = x.sum(axis=0) - L @ x
+        s2 = (x**2).sum(axis=0) - L @ x**2
+        avr = s1/n
+        var = (s2 - s1*avr) / (n-1)
+    avr[n < 1] = np.nan
+    var[n < 2] = np.nan
+    return avr + center, np.sqrt(np.clip(var, 0, None)), n
+
+
+def leave_out_corr(x, y, L):
+    """
+    Pearson correlations between all columns of x and y, as in corr(), 
+    for each subset of rows left out.
+
+    The pairwise-complete sums and cross-products of all rows are 
+    computed once, and the contributions of the rows left out are 
+    subtracted.
+
+    Args:
+        x (pd.DataFrame): observations (rows) by variables (columns).
+        y (pd.DataFrame): second set of variables on the same rows.
+        L (np.ndarray): subsets x rows matrix of the rows left out, as 
+          returned by leave_out().
+
+    Returns:
+        tuple: arrays (subsets x X x Y) of coefficients and p-values.
+    """
+    X = x.values.astype(float)
+    Y = y.values.astype(float)
+    mx = ~np.isnan(X)
+    my = ~np.isnan(Y)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        X = X - np.nansum(X, axis=0) / mx.sum(axis=0)
+        Y = Y - np.nansum(Y, axis=0) / my.sum(axis=0)
+    X = np.where(mx, X, 0)
+    Y = np.where(my, Y, 0)
+    mx = mx.astype(float)
+    my = my.astype(float)
+
+    # Sums over all pairwise-complete rows, minus those left out
+    sums = lambda a, b: a.T @ b - np.einsum('ls,sp,sq->lpq', L, a, b)
+    n = sums(mx, my)
+    sx = sums(X, my)
+    sy = sums(mx, Y)
+    sxx = sums(X**2, my)
+    syy = sums(mx, Y**2)
+    sxy = sums(X, Y)
+    return _pearson(n, sx, sy, sxx, syy, sxy)
+
+
+def leave_out_ttest(x, y, L):
+    """
+    Paired t-tests between the columns of x and y, as in paired_ttest(),
+    for each subset of rows left out.
+
+    Args:
+        x (np.ndarray): subjects (rows) by parameters (columns) for 
+          the first condition, with NaN for missing values.
+        y (np.ndarray): same for the second condition.
+        L (np.ndarray): subsets x subjects matrix of the subjects left
+          out, as returned by leave_out().
+
+    Returns:
+        tuple: arrays (subsets x parameters) of T-values and p-values.
+    """
+    avr, std, n = leave_out_describe(x - y, L)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        T = avr / (std / np.sqrt(n))
+        p = 2 * stats.t.sf(np.abs(T), n - 1)
+    return T, p
+
+
+def adjust_p(p, method='fdr_bh', symmetric=False):
+    """
+    Adjust p-values for multiple testing, as in pingouin.multicomp.
+
+    All values of the array are treated as one family, ignoring NaN
+    values. Requires a single sort whatever the size of the family.
+
+    Args:
+        p (array-like): uncorrected p-values of any shape.
+        method (str, optional): 'holm' (Holm-Bonferroni), 'fdr_bh' 
+          (Benjamini-Hochberg) or 'fdr_by' (Benjamini-Yekutieli). 
+          Defaults to 'fdr_bh'.
+        symmetric (bool, optional): If True, p is a symmetric matrix of
+          correlations of a set of variables with itself. The family is
+          then the upper triangle without the diagonal, and the result
+          is mirrored to the lower triangle. Defaults to False.
+
+    Returns:
+        np.ndarray: adjusted p-values in the shape of p.
+    """
+    p = np.asarray(p, dtype=float)
+    if symmetric:
+        upper = np.triu(np.ones(p.shape, dtype=bool), k=1)
+        padj = np.where(np.eye(len(p), dtype=bool), p, np.nan)
+        padj[upper] = adjust_p(p[upper], method)
+        return np.where(upper.T, padj.T, padj)
+
+    out = np.full(p.shape, np.nan)
+    ok = ~np.isnan(p)
+    pv = p[ok]
+    m = pv.size
+    if m == 0:
+        return out
+    order = np.argsort(pv, kind='stable')
+    ps = pv[order]
+    rank = np.arange(1, m + 1)
+    if method == 'holm':
+        adj = np.maximum.accumulate((m - rank + 1) * ps)
+    elif method in ['fdr_bh', 'fdr_by']:
+        adj = ps * m / rank
+        if method == 'fdr_by':
+            adj *= np.sum(1.0 / rank)
+        adj = np.minimum.accumulate(adj[::-1])[::-1]
+    else:
+        raise ValueError(f"Unknown correction method {method}")
+    adjusted = np.empty(m)
+    adjusted[order] = np.clip(adj, 0, 1)
+    out[ok] = adjusted
+    return out
@@ -0,0 +1,157 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from stages import lazy, data, store
+
+pd = lazy.module('pandas')
+pa = lazy.module('pyarrow')
+feather = lazy.module('pyarrow.feather')
+hierarchy = lazy.module('scipy.cluster.hierarchy')
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+# Correlation panels, each liver panel followed by the panels that use
+# its order of the liver parameters.
+PANELS = {
+    'corr_control': ['corr_blood_control', 'corr_aorta_control', 'corr_screening'],
+    'corr_liver_effect': ['corr_blood_effect', 'corr_aorta_effect'],
+}
+
+
+def _key(df):
+    # Hash of the values and labels of a matrix
+    h = hashlib.sha256()
+    h.update(repr(df.shape).encode())
+    h.update(np.ascontiguousarray(df.values, dtype=float).tobytes())
+    h.update(json.dumps([list(map(str, df.index)), list(map(str, df.columns))]).encode())
+    return h.hexdigest()[:32]
+
+
+_cache = {}
+
+
+def linkage(df):
+    """
+    Hierarchical clustering of the rows of a matrix, as in
+    seaborn.clustermap (average linkage, euclidean distance).
+
+    Results are cached on disk in build/Store, keyed by a hash of the
+    matrix, so that each matrix is only clustered once across figures,
+    processes and runs.
+
+    Args:
+        df (pd.DataFrame): matrix with the observations to cluster as
+          rows.
+
+    Returns:
+        tuple: the linkage matrix and the leaf order of the rows.
+    """
+    key = _key(df)
+    if key in _cache:
+        return _cache[key]
+    path = store.path('linkage_' + key)
+    if os.path.exists(path):
+        table = feather.read_table(path)
+        Z = np.column_stack([table[c].to_numpy() for c in table.column_names])
+        leaves = json.loads(table.schema.metadata[b'leaves'])
+    else:
+        Z = hierarchy.linkage(df.values, method='average', metric='euclidean')
+        leaves = hierarchy.dendrogram(Z, no_plot=True, color_threshold=-np.inf)['leaves']
+        table = pa.table({str(i): Z[:, i] for i in range(Z.shape[1])})
+        table = table.replace_schema_metadata({'leaves': json.dumps(leaves)})
+        store.write_feather(table, path)
+    _cache[key] = (Z, leaves)
+    return Z, leaves
+
+
+def order(df):
+    """
+    Leaf order of the rows of a matrix, from the cached linkage.
+    """
+    return linkage(df)[1]
+
+
+def heatmap_order(vals, cols=None):
+    """
+    Order of the rows (liver parameters) and columns of a correlation
+    panel.
+
+    Args:
+        vals (pd.DataFrame): correlation coefficients, as saved by the
+          stats stage in <block>_vals.
+        cols (list, optional): fixed order of the rows. If not provided,
+          the rows are clustered.
+
+    Returns:
+        tuple: lists of the parameters on the rows and columns.
+    """
+    vals = vals.T
+    if cols is None:
+        vals = vals.iloc[order(vals), :]
+    else:
+        vals = vals.loc[[c for c in cols if c in vals.index], :]
+    vals = vals.iloc[:, order(vals.T)]
+    return list(vals.index), list(vals.columns)
+
+
+def _zscores(vals):
+    # Z-scores of the columns without missing values
+    vals = (vals - vals.mean())/vals.std(ddof=0)
+    vals = vals.dropna(axis=1, how='any')
+    return vals[sorted(set(vals.columns) - set(data.EXCLUDE_EFFECT))]
+
+
+def clustering_matrix():
+    """
+    Z-scores of the screening values, control values and absolute
+    effect sizes (subjects x parameters), labelled for display.
+    """
+    vals = _zscores(store.read('effect_size_absolute'))
+    vals = vals.rename(lambda x: 'Delta ' + data.lookup_vals(x, 'label'), axis=1)
+    vals.index = [str(i) for i in vals.index]
+    for name in ['vals_control', 'vals_screening']:
+        vals0 = _zscores(store.read(name).T)
+        vals0 = vals0.rename(lambda x: data.lookup_vals(x, 'label'), axis=1)
+        vals0 = vals0.loc[vals.index]
+        vals = pd.concat([vals0, vals], axis=1)
+    return vals
+
+
+def manifest():
+    """
+    Path of the list of cached linkages, written by main().
+    """
+    return os.path.join(store.storepath, 'linkage.json')
+
+
+def main():
+    """
+    Cluster all matrices shown in the figures, so that the figures only
+    read the cached orders.
+
+    Cached linkages of other matrices, e.g. of earlier versions of the
+    data, are deleted, and the cached ones are listed in manifest().
+    """
+    _cache.clear()
+    for liver, panels in PANELS.items():
+        _, cols = heatmap_order(store.read(liver + '_vals'))
+        for panel in panels:
+            heatmap_order(store.read(panel + '_vals'), cols)
+    vals = clustering_matrix()
+    linkage(vals)
+    linkage(vals.T)
+
+    # Prune the cache
+    keep = {os.path.basename(store.path('linkage_' + key)) for key in _cache}
+    for file in os.listdir(store.storepath):
+        if file.startswith('linkage_') and file.endswith('.feather') and file not in keep:
+            os.remove(os.path.join(store.storepath, file))
+    with open(manifest(), 'w') as f:
+        json.dump(sorted(_cache), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,21 @@
 import os
+import io
+import csv
+import json
+import copy
+import zlib
+import struct
+import zipfile
+import shutil
+import hashlib
+import tempfile
 import numpy as np
-import pydmr
-import miblab
+
+from stages import lazy
+
+pd = lazy.module('pandas')
+pydmr = lazy.module('pydmr')
+miblab = lazy.module('miblab')
 
 root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 
@@ -17,136 +31,517 @@ IND = {
     'cluster': 6,
 }
 
+class MetadataIndex:
+    """
+    Parameter metadata of a dmr file, loaded once and reloaded only when 
+    the file changes on disk.
+    """
+
+    # Properties with a reverse index (value -> parameters)
+    REVERSE = ['group', 'cluster', 'type']
+
+    def __init__(self, file):
+        self.file = file
+        self._mtime = None
+        self._data = {}
+        self._reverse = {}
+
+    def _refresh(self):
+        stat = os.stat(self.file + '.zip')
+        mtime = (stat.st_mtime_ns, stat.st_size)
+        if mtime == self._mtime:
+            return
+        self._data = pydmr.read(self.file)['data']
+        self._reverse = {prop: {} for prop in self.REVERSE}
+        for p, row in self._data.items():
+            for prop in self.REVERSE:
+                self._reverse[prop].setdefault(row[IND[prop]], []).append(p)
+        self._mtime = mtime
+
+    def get(self, parameter, prop):
+        self._refresh()
+        return self._data[parameter][IND[prop]]
+
+    def params(self, prop, value):
+        self._refresh()
+        if prop in self._reverse:
+            return list(self._reverse[prop].get(value, []))
+        return [p for p, row in self._data.items() if row[IND[prop]]==value]
+
+
+metadata = MetadataIndex(os.path.join(root, 'build', 'Data', 'all_data.dmr'))
+
+
 def lookup_vals(parameters, prop):
-    file = os.path.join(root, 'build', 'Data', 'all_data.dmr')
-    data = pydmr.read(file)['data']
     if isinstance(parameters, str):
-        return data[parameters][IND[prop]]
+        return metadata.get(parameters, prop)
     else:
-        return [data[p][IND[prop]] for p in parameters]
+        return [metadata.get(p, prop) for p in parameters]
 
 def lookup_params(prop, value):
-    file = os.path.join(root, 'build', 'Data', 'all_data.dmr')
-    data = pydmr.read(file)['data']
-    return [p for p in data if data[p][IND[prop]]==value]
+    return metadata.params(prop, value)
+
+
+# Source archives as (Zenodo record, file name)
+DOWNLOADS = [
+    ('15610350', 'tristan_humans_healthy_controls_all_results.dmr.zip'),
+    ('15610350', 'tristan_humans_healthy_rifampicin_all_results.dmr.zip'),
+    ('15610541', 'tristan_humans_healthy_rifampicin_data.dmr.zip'),
+]
+
+# Local cache of pristine downloads, kept outside of the build folder
+cachepath = os.environ.get(
+    'TRISTAN_CACHE', 
+    os.path.join(os.path.expanduser('~'), '.cache', 'tristan-human-stage-3'),
+)
+
+
+def _sha256(file):
+    h = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _md5(file):
+    h = hashlib.md5()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
 
 
-def download():
+def _cache_index():
+    file = os.path.join(cachepath, 'index.json')
+    if not os.path.exists(file):
+        return {}
+    with open(file, 'r') as f:
+        return json.load(f)
+
+
+def _cache_store(record, filename, file):
+    # Store a file under its content hash and index it by record/filename
+    sha = _sha256(file)
+    objects = os.path.join(cachepath, 'objects')
+    os.makedirs(objects, exist_ok=True)
+    blob = os.path.join(objects, sha)
+    if not os.path.exists(blob):
+        shutil.copyfile(file, blob + '.tmp')
+        os.replace(blob + '.tmp', blob)
+    index = _cache_index()
+    index[f"{record}/{filename}"] = sha
+    with open(os.path.join(cachepath, 'index.json.tmp'), 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(
+        os.path.join(cachepath, 'index.json.tmp'), 
+        os.path.join(cachepath, 'index.json'),
+    )
+    return blob
+
+
+def _zenodo_md5(record, filename):
+    # Checksum published by Zenodo for a file in a record
+    import requests
+    response = requests.get(f"https://zenodo.org/api/records/{record}", timeout=60)
+    response.raise_for_status()
+    for f in response.json()['files']:
+        if f['key'] == filename:
+            return f['checksum'].split(':')[-1]
+    raise ValueError(f"{filename} is not a file of Zenodo record {record}.")
+
+
+def cache_add(record, filename, file):
     """
-    Download the data from Zenodo and store it in the build/Data folder.
+    Add a local copy of a Zenodo file to the cache, so that it can be 
+    used in offline mode on machines without network access.
     """
+    return _cache_store(record, filename, file)
 
-    folder = os.path.join(root, 'build', 'Data')
-    
-    miblab.zenodo_fetch('tristan_humans_healthy_controls_all_results.dmr.zip', folder, '15610350')
-    miblab.zenodo_fetch('tristan_humans_healthy_rifampicin_all_results.dmr.zip', folder, '15610350')
-    miblab.zenodo_fetch('tristan_humans_healthy_rifampicin_data.dmr.zip', folder, '15610541')
 
+def fetch(record, filename, offline=False):
+    """
+    Return the path to a verified pristine copy of a Zenodo file in the 
+    cache, downloading it first if needed.
+
+    Args:
+        record (str): Zenodo record.
+        filename (str): file in the record.
+        offline (bool, optional): If True, only the cache is used. 
+          Defaults to False.
 
-def set_metadata():
+    Raises:
+        FileNotFoundError: in offline mode, if the file is not cached.
+        ValueError: if a file does not match its checksum.
+
+    Returns:
+        str: path to the file in the cache.
     """
-    Replace the metadata in the downloaded data with static metadata.
+    sha = _cache_index().get(f"{record}/{filename}")
+    if sha is not None:
+        blob = os.path.join(cachepath, 'objects', sha)
+        if os.path.exists(blob):
+            if _sha256(blob) == sha:
+                return blob
+            os.remove(blob)
+            if offline:
+                raise ValueError(
+                    f"Cached copy of {filename} (record {record}) is corrupt "
+                    "and cannot be downloaded again in offline mode."
+                )
+    if offline:
+        raise FileNotFoundError(
+            f"{filename} (record {record}) is not in the cache at "
+            f"{cachepath}. Run once with network access or add it with "
+            "data.cache_add()."
+        )
+
+    # Download to a temporary folder and verify against Zenodo
+    os.makedirs(cachepath, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cachepath)
+    try:
+        file = miblab.zenodo_fetch(filename, tmp, record)
+        if _md5(file) != _zenodo_md5(record, filename):
+            raise ValueError(
+                f"Download of {filename} (record {record}) does not match "
+                "the checksum published on Zenodo."
+            )
+        return _cache_store(record, filename, file)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+# Downloads whose metadata are replaced by the static metadata
+MRI_RESULTS = [
+    'tristan_humans_healthy_controls_all_results.dmr.zip', 
+    'tristan_humans_healthy_rifampicin_all_results.dmr.zip',
+]
+
+# Subjects excluded from the study
+EXCLUDE_SUBJECTS = ['SHF-007', 'SHF-010', 'SHF-016']
+
+
+def _csv(rows):
+    buffer = io.StringIO(newline='')
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+def write(file, dmr, reuse=True):
     """
-    file = os.path.join(root, '_static', 'MRI_metadata')
-    meta = pydmr.read(file)
-    folder = os.path.join(root, 'build', 'Data')
-    
-    for dataset in [
-            'tristan_humans_healthy_controls_all_results.dmr.zip', 
-            'tristan_humans_healthy_rifampicin_all_results.dmr.zip',
-        ]:
-        file = os.path.join(folder, dataset)
-        dmr = pydmr.read(file)
-        dmr['data'] = meta['data']
-        dmr['columns'] = meta['columns']
-        pydmr.write(file, dmr)
+    Save a dmr dictionary (flat format) to a .dmr.zip file.
 
+    The csv files are formatted as by pydmr.write, but written directly
+    to the archive without a temporary folder.
 
-def combine():
+    Args:
+        file (str): path to the file, with or without .zip extension.
+        dmr (dict): dmr dictionary in flat format.
+        reuse (bool, optional): If True, csv files with the same 
+          checksum and size as in an existing file are copied from it 
+          without compressing them again, and an existing file with 
+          the same contents is not rewritten at all. Defaults to True.
+
+    Returns:
+        bool: True if the file was written.
     """
-    Combine the data from the downloaded datasets into a single Data.dmr file.
+    if not file.endswith('.zip'):
+        file += '.zip'
+    header = ['parameter', 'description', 'unit', 'type'] + dmr.get('columns', [])
+    members = {'data.csv': _csv([header] + [[p] + v for p, v in dmr['data'].items()])}
+    for var in ['pars', 'sdev']:
+        if var not in dmr:
+            continue
+        rows = [['subject', 'study', 'parameter', 'value']]
+        for key, value in dmr[var].items():
+            if isinstance(value, (bool, np.bool_)):
+                value = '1' if value else '0'
+            rows.append(list(key) + [value])
+        members[var + '.csv'] = _csv(rows)
+
+    reused = {}
+    if reuse and os.path.exists(file) and zipfile.is_zipfile(file):
+        with zipfile.ZipFile(file) as z:
+            old = {i.filename: i for i in z.infolist()}
+        new = {m: (zlib.crc32(b), len(b)) for m, b in members.items()}
+        if {m: (i.CRC, i.file_size) for m, i in old.items()} == new:
+            return False
+        # Compressed bytes of the unchanged members
+        reused = _read_raw(file, [
+            i for m, i in old.items() if m in new
+            and (i.CRC, i.file_size) == new[m]
+            and i.compress_type == zipfile.ZIP_DEFLATED
+            and not i.flag_bits & 0x08 # no data descriptor
+        ])
+
+    tmp = file + '.tmp'
+    with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as z:
+        for member, content in members.items():
+            if member in reused and _can_write_raw(z):
+                _write_raw(z, *reused[member])
+            else:
+                z.writestr(member, content)
+    os.replace(tmp, file)
+    return True
+
+
+def _read_raw(file, infos):
+    # Compressed bytes of members of an archive, skipping their local 
+    # headers (30 bytes, then the name and extra field).
+    raw = {}
+    with open(file, 'rb') as f:
+        for info in infos:
+            f.seek(info.header_offset + 26)
+            name, extra = struct.unpack('<HH', f.read(4))
+            f.seek(name + extra, 1)
+            raw[info.filename] = (info, f.read(info.compress_size))
+    return raw
+
+
+def _can_write_raw(z):
+    # _write_raw relies on zipfile internals. If they are not there, 
+    # e.g. in another Python version, members are compressed again.
+    attrs = ['fp', 'start_dir', 'filelist', 'NameToInfo', '_didModify']
+    return all(hasattr(z, a) for a in attrs) and hasattr(zipfile.ZipInfo, 'FileHeader')
+
+
+def _write_raw(z, info, raw):
+    # Add compressed bytes to a ZipFile opened for writing. zipfile has 
+    # no public API for this, so the entry is added as in 
+    # zipfile._ZipWriteFile.close().
+    info = copy.copy(info)
+    z.fp.seek(z.start_dir)
+    info.header_offset = z.fp.tell()
+    z.fp.write(info.FileHeader())
+    z.fp.write(raw)
+    z.start_dir = z.fp.tell()
+    z.filelist.append(info)
+    z.NameToInfo[info.filename] = info
+    z._didModify = True
+
+
+def download(offline=None):
+    """
+    Copy the data from the download cache to the build/Data folder, 
+    downloading them from Zenodo if they are not yet cached. The MRI 
+    results are saved with the static metadata.
+
+    Args:
+        offline (bool, optional): If True, use the cache only. By 
+          default this is set by the environment variable 
+          TRISTAN_OFFLINE=1.
+
+    Returns:
+        dict: the data of each file, as flat dmr dictionaries.
     """
+    if offline is None:
+        offline = os.environ.get('TRISTAN_OFFLINE', '0') == '1'
+
     folder = os.path.join(root, 'build', 'Data')
-    
-    files = [
-        os.path.join(folder, 'tristan_humans_healthy_controls_all_results.dmr.zip'),
-        os.path.join(folder, 'tristan_humans_healthy_rifampicin_all_results.dmr.zip'),
-        os.path.join(folder, 'tristan_humans_healthy_rifampicin_data.dmr.zip'),
-    ]
-    
-    file = os.path.join(folder, 'all_data.dmr')
-    pydmr.concat(files, file)
-    pydmr.drop(file, subject=['SHF-007', 'SHF-010', 'SHF-016'])
+    meta = pydmr.read(os.path.join(root, '_static', 'MRI_metadata'))
+
+    dmrs = {}
+    tmp = tempfile.mkdtemp()
+    try:
+        for record, filename in DOWNLOADS:
+            blob = fetch(record, filename, offline)
+            file = os.path.join(folder, filename)
+            if filename in MRI_RESULTS:
+                # pydmr needs the file extension to read the blob
+                dmr = pydmr.read(shutil.copyfile(blob, os.path.join(tmp, filename)))
+                dmrs[filename] = set_metadata(dmr, meta)
+                write(file, dmrs[filename])
+            else:
+                dmrs[filename] = pydmr.read(shutil.copyfile(blob, file))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return dmrs
 
 
-def compute_sdev():
+def set_metadata(dmr, meta):
     """
-    Compute the standard deviations for derived parameters.
+    Replace the metadata of a dataset with static metadata.
     """
-    file = os.path.join(root, 'build', 'Data', 'all_data.dmr')
-    data = pydmr.read(file, 'nest')
-
-    for subj in data['pars']:
-        for study in data['pars'][subj]:
-            try:
-                v = data['pars'][subj][study]
-                sd = data['sdev'][subj][study]
-                Th_sd = 0.5 * np.sqrt(sd['Th_i']**2 + sd['Th_f']**2)
-                khe_sd = 0.5 * np.sqrt(sd['khe_i']**2 + sd['khe_f']**2)
-                kbh_sd = np.sqrt(
-                    (Th_sd * (1 - v['ve']) / v['Th']**2)**2 + 
-                    (sd['ve'] / v['Th'])**2
+    dmr['data'] = meta['data']
+    dmr['columns'] = meta['columns']
+    return dmr
+
+
+def combine(dmrs):
+    """
+    Combine the data from the downloaded datasets into a single dataset,
+    as pydmr.concat, and remove excluded subjects.
+    """
+    dmr = {'data': {}}
+    for filename, dmr_file in dmrs.items():
+        dmr['data'] = dmr['data'] | dmr_file['data']
+        if 'columns' in dmr_file:
+            if dmr.setdefault('columns', dmr_file['columns']) != dmr_file['columns']:
+                raise ValueError(
+                    'Cannot combine: all data dictionaries must have the '
+                    'same optional columns.'
                 )
-                sd['khe'] = khe_sd
-                sd['kbh'] = kbh_sd
-                sd['Th'] = Th_sd
-            except KeyError:
-                pass
+        for var in ['pars', 'sdev']:
+            if var not in dmr_file:
+                continue
+            if not dmr.setdefault(var, {}).keys().isdisjoint(dmr_file[var].keys()):
+                raise ValueError(
+                    f"Cannot combine: duplicate indices in {var}.csv of {filename}."
+                )
+            dmr[var] = dmr[var] | dmr_file[var]
+    return pydmr.pydict.dict_drop(dmr, EXCLUDE_SUBJECTS, None, None)
 
-    pydmr.write(file, data, 'nest')    
 
+# Derived quantities, in order of evaluation. Each entry lists the 
+# parameters it needs (inputs) and how to compute the value and/or the 
+# standard deviation from the values (v) and standard deviations (sd) 
+# of each visit. New parameters also need a row in the data dictionary 
+# (meta). Entries with only an sdev add the standard deviation of a 
+# measured parameter.
+DERIVED = {
+    'Th': {
+        'inputs': ['Th_i', 'Th_f'],
+        'sdev': lambda v, sd: 0.5 * np.sqrt(sd['Th_i']**2 + sd['Th_f']**2),
+    },
+    'khe': {
+        'inputs': ['khe_i', 'khe_f'],
+        'sdev': lambda v, sd: 0.5 * np.sqrt(sd['khe_i']**2 + sd['khe_f']**2),
+    },
+    'kbh': {
+        'inputs': ['Th', 've'],
+        'sdev': lambda v, sd: np.sqrt(
+            (sd['Th'] * (1 - v['ve']) / v['Th']**2)**2 + 
+            (sd['ve'] / v['Th'])**2
+        ),
+    },
+    'khe_slope': {
+        'meta': ['khe change per time', 'mL/min/100cm3/hr', 'float', 'MRI - liver', 'Dk(he)', 'NaN', 'HC'],
+        'inputs': ['khe_f', 'khe_i', 't3', 't0'],
+        'value': lambda v: (v['khe_f'] - v['khe_i']) / (v['t3'] - v['t0']),
+    },
+    'kbh_slope': {
+        'meta': ['kbh change per time', 'mL/min/100cm3/hr', 'float', 'MRI - liver', 'Dk(bh)', 'NaN', 'HC'],
+        'inputs': ['kbh_f', 'kbh_i', 't3', 't0'],
+        'value': lambda v: (v['kbh_f'] - v['kbh_i']) / (v['t3'] - v['t0']),
+    },
+    'R1_45min': {
+        'meta': ['R1 at 45mins', '1/sec', 'float', 'MRI - liver', 'R1(45)', 'NaN', 'SQ'],
+        'inputs': ['T1_2'],
+        'value': lambda v: 1 / v['T1_2'],
+    },
+    'DR1_45min': {
+        'meta': ['Delta R1 at 45mins', '1/sec', 'float', 'MRI - liver', 'DR1(45)', 'NaN', 'SQ'],
+        'inputs': ['T1_2', 'T1_1'],
+        'value': lambda v: 1 / v['T1_2'] - 1 / v['T1_1'],
+    },
+    'R1_scan2': {
+        'meta': ['R1 (scan 2)', '1/sec', 'float', 'MRI - liver', 'R1(2)', 'NaN', 'SQ'],
+        'inputs': ['T1_3'],
+        'value': lambda v: 1 / v['T1_3'],
+    },
+    'DR1_scan2': {
+        'meta': ['Delta R1 (scan 2)', '1/sec', 'float', 'MRI - liver', 'DR1(2)', 'NaN', 'SQ'],
+        'inputs': ['T1_3', 'T1_1'],
+        'value': lambda v: 1 / v['T1_3'] - 1 / v['T1_1'],
+    },
+} | {
+    # Averages of liver function tests before and after the MRI
+    'Avr' + p: {
+        'meta': [f'Average {name}', unit, 'float', 'Blood - liver function test', label, 'NaN', 'Blood - liver function test'],
+        'inputs': ['Pre' + p, 'Post' + p],
+        'value': lambda v, p=p: (v['Pre' + p] + v['Post' + p]) / 2,
+    }
+    for p, name, unit, label in [
+        ('Alb', 'Albumin', 'g/L', 'Alb'),
+        ('ALP', 'ALP', 'U/L', 'ALP'),
+        ('ALT', 'ALT', 'U/L', 'ALT'),
+        ('Bili', 'Bilirubin', 'umol/L', 'Bil'),
+        ('ConBili', 'Conjugated Bilirubin', 'umol/L', 'CBil'),
+        ('ConTotBili', 'Conjugated/total bilirubin', '%', 'CTBil'),
+    ]
+}
+
+
+def _wide(values, columns):
+    # Subject x visit table of the values, with a column for each 
+    # parameter in columns (NaN if not measured).
+    if len(values) == 0:
+        return pd.DataFrame(columns=columns, dtype=float)
+    wide = pd.Series(values, dtype=float).unstack()
+    return wide.reindex(columns=columns)
+
+
+def _derive(dmr, key):
+    # Evaluate the entries of DERIVED for key ('value' or 'sdev') on 
+    # all visits at once, and add the results to dmr. Missing inputs 
+    # propagate as NaN, and NaN results are not saved.
+    entries = {p: e for p, e in DERIVED.items() if key in e}
+    inputs = sorted({i for e in entries.values() for i in e['inputs']} | set(entries))
+    v = _wide(dmr['pars'], inputs)
+    sd = _wide(dmr.get('sdev', {}), inputs).reindex(v.index)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for p, entry in entries.items():
+            if key == 'value':
+                v[p] = entry['value'](v)
+                dmr['data'][p] = entry['meta']
+            else:
+                sd[p] = entry['sdev'](v, sd)
+            result = (v if key == 'value' else sd)[p].dropna()
+            dmr['pars' if key == 'value' else 'sdev'].update({
+                (subj, study, p): float(x) for (subj, study), x in result.items()
+            })
+
+
+def compute_sdev(dmr):
+    """
+    Compute the standard deviations for derived parameters.
+    """
+    _derive(dmr, 'sdev')
+    return dmr
 
-def compute_derived():
+
+def compute_derived(dmr):
     """
     Define and compute derived parameters.
     """
-    file = os.path.join(root, 'build', 'Data', 'all_data.dmr')
-    data = pydmr.read(file, 'nest')
-
-    # Define derived parameters
-    data['data'] = data['data'] | {
-        'khe_slope': ['khe change per time', 'mL/min/100cm3/hr', 'float', 'MRI - liver', 'Dk(he)', 'NaN', 'HC'],
-        'kbh_slope': ['kbh change per time', 'mL/min/100cm3/hr', 'float', 'MRI - liver', 'Dk(bh)', 'NaN', 'HC'],
-        'R1_45min': ['R1 at 45mins', '1/sec', 'float', 'MRI - liver', 'R1(45)', 'NaN', 'SQ'],
-        'DR1_45min': ['Delta R1 at 45mins', '1/sec', 'float', 'MRI - liver', 'DR1(45)', 'NaN', 'SQ'],
-        'R1_scan2': ['R1 (scan 2)', '1/sec', 'float', 'MRI - liver', 'R1(2)', 'NaN', 'SQ'],
-        'DR1_scan2': ['Delta R1 (scan 2)', '1/sec', 'float', 'MRI - liver', 'DR1(2)', 'NaN', 'SQ'],
-        'AvrAlb': ['Average Albumin', 'g/L', 'float', 'Blood - liver function test', 'Alb', 'NaN', 'Blood - liver function test'],
-        'AvrALP': ['Average ALP', 'U/L', 'float', 'Blood - liver function test', 'ALP', 'NaN', 'Blood - liver function test'],
-        'AvrALT': ['Average ALT', 'U/L', 'float', 'Blood - liver function test', 'ALT', 'NaN', 'Blood - liver function test'],
-        'AvrBili': ['Average Bilirubin', 'umol/L', 'float', 'Blood - liver function test', 'Bil', 'NaN', 'Blood - liver function test'],
-        'AvrConBili': ['Average Conjugated Bilirubin', 'umol/L', 'float', 'Blood - liver function test', 'CBil', 'NaN', 'Blood - liver function test'],
-        'AvrConTotBili': ['Average Conjugated/total bilirubin', '%', 'float', 'Blood - liver function test', 'CTBil', 'NaN', 'Blood - liver function test'],
+    _derive(dmr, 'value')
+    return dmr
+
+
+def _group_visits(values):
+    # Order by subject and visit (in order of first appearance), so 
+    # that the values of each visit are listed together.
+    visits = {}
+    for key, value in values.items():
+        visits.setdefault(key[0], {}).setdefault(key[1], []).append((key, value))
+    return {
+        key: value for studies in visits.values() 
+        for items in studies.values() for key, value in items
     }
 
-    # Compute derived parameters
-    for subj in data['pars']:
-        for study in data['pars'][subj]:
-            try:
-                v = data['pars'][subj][study]
-                v['khe_slope'] = (v['khe_f']-v['khe_i'])/(v['t3']-v['t0'])
-                v['kbh_slope'] = (v['kbh_f']-v['kbh_i'])/(v['t3']-v['t0'])
-                v['R1_45min'] = 1/v['T1_2']
-                v['DR1_45min'] = 1/v['T1_2'] - 1/v['T1_1']
-                v['R1_scan2'] = 1/v['T1_3']
-                v['DR1_scan2'] = 1/v['T1_3'] - 1/v['T1_1']
-                for p in ['Alb', 'ALP', 'ALT', 'Bili', 'ConBili', 'ConTotBili']:
-                    v['Avr'+p] = (v['Pre'+p] + v['Post'+p])/2
-            except KeyError:
-                pass
-            
-    # Save results
-    pydmr.write(file, data, 'nest')
+
+def all_data(dmrs=None):
+    """
+    Combine the downloaded data and compute derived parameters in 
+    memory, and save the result as all_data.dmr.
+
+    Args:
+        dmrs (dict, optional): downloaded data as returned by 
+          download(). If not provided they are read from build/Data.
+
+    Returns:
+        dict: the combined data as a flat dmr dictionary.
+    """
+    folder = os.path.join(root, 'build', 'Data')
+    if dmrs is None:
+        dmrs = {f: pydmr.read(os.path.join(folder, f)) for _, f in DOWNLOADS}
+    dmr = combine(dmrs)
+    dmr = compute_sdev(dmr)
+    dmr = compute_derived(dmr)
+    for var in ['pars', 'sdev']:
+        dmr[var] = _group_visits(dmr[var])
+    write(os.path.join(folder, 'all_data.dmr'), dmr)
+    return dmr
 
 
 # Parameters excluded from response assesment forvarious reasons
@@ -176,23 +571,26 @@ EXCLUDE_EFFECT = [
 ]
 
 
-def select_response_markers():
+def select_response_markers(dmr=None):
     """
     Save the response markers to a new file, excluding parameters with uninteresting effect sizes.
+
+    Args:
+        dmr (dict, optional): all data as returned by all_data(). If 
+          not provided they are read from all_data.dmr.
     """
     # Parameters with uninteresting effect sizes
     file = os.path.join(root, 'build', 'Data', 'all_data.dmr')
     result = os.path.join(root, 'build', 'Data', 'all_data_effect.dmr')
-    pydmr.drop(file, result, parameter=EXCLUDE_EFFECT, study='screening', subject=['1','5'])
+    dmr = pydmr.read(file) if dmr is None else dict(dmr)
+    dmr = pydmr.pydict.dict_drop(dmr, ['1','5'], 'screening', EXCLUDE_EFFECT)
+    write(result, dmr)
 
 
 def main():
-    download()
-    set_metadata()
-    combine()
-    compute_sdev()
-    compute_derived()
-    select_response_markers()
+    dmrs = download()
+    dmr = all_data(dmrs)
+    select_response_markers(dmr)
 
 if __name__=='__main__':
-    main()
\ No newline at end of file
+    main()
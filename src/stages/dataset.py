@@ -0,0 +1,256 @@
+import os
+import json
+import zipfile
+
+import numpy as np
+
+from stages import lazy, store
+
+pd = lazy.module('pandas')
+pa = lazy.module('pyarrow')
+pacsv = lazy.module('pyarrow.csv')
+feather = lazy.module('pyarrow.feather')
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+ALL_DATA = os.path.join(root, 'build', 'Data', 'all_data.dmr')
+EFFECT_DATA = os.path.join(root, 'build', 'Data', 'all_data_effect.dmr')
+
+
+class Dataset:
+    """
+    Values and standard deviations of a dmr file, read selectively.
+
+    The csv files in the archive are indexed on first use: subject,
+    study and parameter are stored as integer codes next to the values
+    in a memory-mapped table in build/Store. Selections only decode the
+    rows they need, so the cost of a query scales with the size of the
+    result rather than the size of the archive.
+    """
+
+    KEYS = ['subject', 'study', 'parameter']
+
+    def __init__(self, file):
+        self.file = file
+        self._index = {}
+
+    def index(self, member):
+        # Index of a csv file in the archive, or None if not included
+        if member not in self._index:
+            self._index[member] = _Index.open(self.file, member)
+        return self._index[member]
+
+    def values(self, study=None, parameter=None, subject=None):
+        """
+        Values in long format (subject, study, parameter, value),
+        optionally restricted to given studies, parameters or subjects.
+        """
+        return self.index('pars').select(subject=subject, study=study, parameter=parameter)
+
+    def sdevs(self, study=None, parameter=None, subject=None):
+        """
+        Standard deviations in the same format as values().
+        """
+        index = self.index('sdev')
+        if index is None:
+            return pd.DataFrame(columns=self.KEYS + ['value'])
+        return index.select(subject=subject, study=study, parameter=parameter)
+
+    def wide(self, study=None, parameter=None, subject=None, index='subject', columns='parameter'):
+        """
+        Values pivoted to a wide table, by default subjects x parameters.
+        """
+        vals = self.values(study=study, parameter=parameter, subject=subject)
+        return vals.pivot(index=index, columns=columns, values='value')
+
+    def cube(self):
+        """
+        All values and standard deviations as a Cube, built on first use.
+        """
+        if 'cube' not in self._index:
+            self._index['cube'] = Cube.build(self.index('pars'), self.index('sdev'))
+        return self._index['cube']
+
+
+class Cube:
+    """
+    Values as a dense subjects x parameters x studies array.
+
+    Labels of each axis are sorted, as in a pivot table. The boolean 
+    array present marks which values are in the data, sdev holds the
+    standard deviations (NaN if not available), and row holds the 
+    position of each value in the source file (-1 if not available).
+    """
+
+    AXES = ['subject', 'parameter', 'study']
+
+    def __init__(self, subjects, parameters, studies, values, present, sdev, row):
+        self.subjects = subjects
+        self.parameters = parameters
+        self.studies = studies
+        self.values = values
+        self.present = present
+        self.sdev = sdev
+        self.row = row
+
+    @classmethod
+    def build(cls, pars, sdev=None):
+        # Positions of the sorted labels
+        labels, pos = {}, {}
+        for key in cls.AXES:
+            labels[key] = pars.labels[key].sort_values()
+            pos[key] = labels[key].get_indexer(pars.labels[key])
+        shape = tuple(len(labels[key]) for key in cls.AXES)
+        s, p, v = (pos[key][pars.codes[key]] for key in cls.AXES)
+
+        values = np.full(shape, np.nan)
+        values[s, p, v] = pars.table['value'].to_numpy(zero_copy_only=False)
+        present = np.zeros(shape, dtype=bool)
+        present[s, p, v] = True
+        row = np.full(shape, -1)
+        row[s, p, v] = np.arange(len(s))
+        sdevs = np.full(shape, np.nan)
+        if sdev is not None:
+            s, p, v = (
+                labels[key].get_indexer(sdev.labels[key])[sdev.codes[key]]
+                for key in cls.AXES
+            )
+            sdevs[s, p, v] = sdev.table['value'].to_numpy(zero_copy_only=False)
+        return cls(
+            labels['subject'], labels['parameter'], labels['study'], 
+            values, present, sdevs, row,
+        )
+
+    def study(self, study):
+        # Position of a study on the last axis
+        return self.studies.get_loc(study)
+
+    def frame(self, study, parameters=None, subjects=None, sdev=False):
+        """
+        Subjects x parameters table of one study, with the subjects and
+        parameters that have values in that study, as returned by 
+        Dataset.wide(study=study).
+
+        Args:
+            study (str): the study.
+            parameters (list, optional): only include these parameters.
+            subjects (list, optional): only include these subjects.
+            sdev (bool, optional): If True, return the standard 
+              deviations instead of the values. Defaults to False.
+        """
+        v = self.study(study)
+        present = self.present[:, :, v].copy()
+        if subjects is not None:
+            present[~self.subjects.isin(subjects), :] = False
+        if parameters is not None:
+            present[:, ~self.parameters.isin(parameters)] = False
+        rows = present.any(axis=1)
+        cols = present.any(axis=0)
+        array = self.sdev if sdev else self.values
+        return self.to_frame(array[:, :, v], rows, cols)
+
+    def to_frame(self, array, rows=None, cols=None):
+        """
+        Wrap a subjects x parameters array, e.g. a difference between 
+        studies, in a table with subject and parameter labels.
+
+        Args:
+            array (np.ndarray): subjects x parameters array.
+            rows (np.ndarray, optional): boolean mask of the subjects 
+              to include. Defaults to all.
+            cols (np.ndarray, optional): boolean mask of the parameters
+              to include. Defaults to all.
+        """
+        if rows is None:
+            rows = np.ones(len(self.subjects), dtype=bool)
+        if cols is None:
+            cols = np.ones(len(self.parameters), dtype=bool)
+        return pd.DataFrame(
+            array[rows][:, cols],
+            index=pd.Index(self.subjects[rows], name='subject'),
+            columns=pd.Index(self.parameters[cols], name='parameter'),
+        )
+
+
+class _Index:
+
+    def __init__(self, table):
+        self.table = table
+        meta = json.loads(table.schema.metadata[b'labels'])
+        self.labels = {key: pd.Index(meta[key]) for key in Dataset.KEYS}
+        # Zero-copy views on the memory-mapped codes
+        self.codes = {key: table[key].to_numpy() for key in Dataset.KEYS}
+
+    @classmethod
+    def open(cls, file, member):
+        """
+        Open the index of a csv file in a dmr archive, building it if
+        it does not exist or is out of date.
+        """
+        with zipfile.ZipFile(file + '.zip') as z:
+            if member + '.csv' not in z.namelist():
+                return None
+            info = z.getinfo(member + '.csv')
+            checksum = f"{info.CRC}:{info.file_size}"
+            path = store.path(os.path.basename(file) + '.' + member)
+            if os.path.exists(path):
+                table = feather.read_table(path, memory_map=True)
+                if table.schema.metadata.get(b'checksum') == checksum.encode():
+                    return cls(table)
+            with z.open(member + '.csv') as f:
+                table = _build(f, checksum)
+        store.write_feather(table, path)
+        return cls(feather.read_table(path, memory_map=True))
+
+    def select(self, **selection):
+        mask = None
+        for key, sel in selection.items():
+            if sel is None:
+                continue
+            if isinstance(sel, str):
+                sel = [sel]
+            wanted = self.labels[key].get_indexer(list(sel))
+            match = np.isin(self.codes[key], wanted[wanted >= 0])
+            mask = match if mask is None else mask & match
+        rows = np.arange(self.table.num_rows) if mask is None else np.flatnonzero(mask)
+        df = pd.DataFrame(
+            {key: self.labels[key].values[self.codes[key][rows]] for key in Dataset.KEYS},
+            index=rows,
+        )
+        df['value'] = self.table['value'].take(rows).to_numpy(zero_copy_only=False)
+        return df
+
+
+def _build(f, checksum):
+    # Parse a csv file of a dmr archive into an indexed table
+    csv = pacsv.read_csv(f, convert_options=pacsv.ConvertOptions(
+        column_types={
+            'subject': pa.string(), 'study': pa.string(),
+            'parameter': pa.string(), 'value': pa.float64(),
+        },
+    ))
+    columns, labels = {}, {}
+    for key in Dataset.KEYS:
+        codes, uniques = pd.factorize(csv[key].to_numpy(zero_copy_only=False))
+        columns[key] = pa.array(codes.astype(np.int32))
+        labels[key] = list(uniques)
+    columns['value'] = csv['value']
+    return pa.table(columns).replace_schema_metadata({
+        'checksum': checksum,
+        'labels': json.dumps(labels),
+    })
+
+
+_cache = {}
+
+
+def load(file=ALL_DATA):
+    """
+    Return the dataset for a dmr file, opened only on first use or if
+    the file has changed since.
+    """
+    stat = os.stat(file + '.zip')
+    key = (stat.st_mtime_ns, stat.st_size)
+    if file not in _cache or _cache[file][0] != key:
+        _cache[file] = (key, Dataset(file))
+    return _cache[file][1]
@@ -1,45 +1,39 @@
 import os
-import math
 
-import pandas as pd
 import numpy as np
-import pydmr
+
+from stages import lazy, data, dataset, calc, store
+
+pd = lazy.module('pandas')
 
 root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 resultspath = os.path.join(root, 'build', 'Tables')
 
+# Confidence intervals of the effect sizes in the averages table: 
+# 'normal' only, or with 'percentile' or 'bca' bootstrap intervals.
+CI = 'bca'
 
 
-def summarise_visits():
 
-    # Get all data as dataframe
-    file = os.path.join(root, 'build', 'Data', 'all_data.dmr')
-    vals = pydmr.read(file, 'pandas')['pars']
-  
-    # Pivot all data
-    kwargs = {
-        'columns': 'subject',
-        'index': ['study', 'parameter'],
-        'values': 'value',
-    }  
-    data_all_visits = vals.pivot(**kwargs)
-    
-    # Pivot data per visit
-    kwargs['index'] = ['parameter']
-    data_screening = vals[vals.study=='screening'].pivot(**kwargs)
-    data_control = vals[vals.study=='control'].pivot(**kwargs)
-    data_drug = vals[vals.study=='drug'].pivot(**kwargs)
+def summarise_visits(dset=None):
+
+    # Get all data as a cube
+    if dset is None:
+        dset = dataset.load(dataset.ALL_DATA)
+    cube = dset.cube()
+
+    # Parameters x subjects per visit
+    visits = {study: cube.frame(study).T for study in cube.studies}
 
-    # Export to csv
-    file_all_visits = os.path.join(resultspath, 'vals.csv')
-    file_screening = os.path.join(resultspath, 'vals_screening.csv')
-    file_control = os.path.join(resultspath, 'vals_control.csv')
-    file_drug = os.path.join(resultspath, 'vals_drug.csv')
+    # All visits
+    data_all_visits = pd.concat(visits, names=['study'])
+    data_all_visits = data_all_visits.reindex(columns=pd.Index(cube.subjects, name='subject'))
 
-    data_all_visits.to_csv(file_all_visits, na_rep="NaN")
-    data_screening.to_csv(file_screening, na_rep="NaN")
-    data_control.to_csv(file_control, na_rep="NaN")
-    data_drug.to_csv(file_drug, na_rep="NaN")
+    # Save and export to csv
+    store.write(data_all_visits, 'vals', na_rep="NaN")
+    store.write(visits['screening'], 'vals_screening', na_rep="NaN")
+    store.write(visits['control'], 'vals_control', na_rep="NaN")
+    store.write(visits['drug'], 'vals_drug', na_rep="NaN")
 
 
     
@@ -69,21 +63,33 @@ def summarise_visits():
     # data_drug.to_csv(file_drug, na_rep="NaN")
 
 
-def effect_size():
+def _visits(cube, exclude=None):
+    # Control and drug values (subjects x parameters), and masks of the 
+    # subjects and parameters with data in either visit.
+    c, d = cube.study('control'), cube.study('drug')
+    present = cube.present[:, :, [c, d]].copy()
+    if exclude is not None:
+        present[cube.subjects.isin(exclude), :, 0] = False
+    x = np.where(present[:, :, 0], cube.values[:, :, c], np.nan)
+    y = np.where(present[:, :, 1], cube.values[:, :, d], np.nan)
+    return x, y, present.any(axis=(1, 2)), present.any(axis=(0, 2))
 
-    # Get all data as dataframe  
-    file = os.path.join(root, 'build', 'Data', 'all_data_effect.dmr')
 
-    dmr = pydmr.read(file, 'pandas', study='control')
-    df0 = dmr['pars'].pivot(columns='parameter', index='subject', values='value')
-    dmr = pydmr.read(file, 'pandas', study='drug')
-    df1 = dmr['pars'].pivot(columns='parameter', index='subject', values='value')
+def effect_size(dset=None):
+
+    # Get all data as a cube
+    if dset is None:
+        dset = dataset.load(dataset.EFFECT_DATA)
+    cube = dset.cube()
+    x, y, rows, cols = _visits(cube)
 
     for abs in [False, True]:
-        if abs:
-            effect = df1-df0
-        else:
-            effect = 100*(df1-df0)/df0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if abs:
+                effect = y-x
+            else:
+                effect = 100*(y-x)/x
+        effect = cube.to_frame(effect, rows, cols)
 
         # drop subjects with only 1 visit
         effect = effect.dropna(axis=0, how='all')
@@ -92,65 +98,92 @@ def effect_size():
 
         # Export effect sizes
         suffix = 'absolute' if abs else 'relative'
-        file = os.path.join(resultspath, f'effect_size_{suffix}.csv')
-        effect.to_csv(file, na_rep="NaN")
+        store.write(effect, f'effect_size_{suffix}', na_rep="NaN")
 
 
-def demographics():
+def demographics(dset=None):
 
-    file = os.path.join(root, 'build', 'Data', 'all_data.dmr')
+    if dset is None:
+        dset = dataset.load(dataset.ALL_DATA)
     demographics = [
         'Age', 'BMI', 'Height', 'Weight', 
         'Crea', 'Urea', 
         'AvrALP', 'AvrALT', 'AvrAlb', 'AvrBili', 'AvrConBili', 'AvrConTotBili', 
     ]
-    dmr = pydmr.read(file, 'pandas', parameter=demographics, study=['control', 'screening'])
-    df = dmr['pars'].pivot(columns='subject', index='parameter', values='value')
+    df = dset.wide(parameter=demographics, study=['control', 'screening'], 
+                   index='parameter', columns='subject')
     df = df.T.describe().T.round(1)
 
-    name = lambda x: f"{pydmr.metadata(file, x, 'description').replace('Average ', '')} ({pydmr.metadata(file, x, 'unit')})"
+    name = lambda x: f"{data.lookup_vals(x, 'name').replace('Average ', '')} ({data.lookup_vals(x, 'unit')})"
     df = df.rename(name, axis=0)
 
     file = os.path.join(resultspath, 'table_demographics.csv')
     df.to_csv(file)
 
 
-def averages():
-    
-    # Concatenate all data
-    file = os.path.join(root, 'build', 'Data', 'all_data_effect.dmr')
-    vals = pydmr.read(file, 'pandas', study=['control', 'drug'])['pars']
-
-    # Get mean, sdev and count of all variables
-    avr = pd.pivot_table(vals, values='value', columns='study', 
-                         index='parameter', aggfunc='mean')
-    std = pd.pivot_table(vals, values='value', columns='study', 
-                         index='parameter', aggfunc='std')
-    cnt = pd.pivot_table(vals, values='value', columns='study', 
-                         index='parameter', aggfunc='count')
-    
-    effect_file = os.path.join(resultspath, 'effect_size_relative.csv')
-    effect = pd.read_csv(effect_file, index_col=0)
-    
-    # Get mean, sdev and count of all effect sizes
-    avr_effect = effect.mean()
-    std_effect = effect.std()
-    cnt_effect = effect.count()
+def _describe(x, axis=0):
+    # Mean, standard deviation and count of the non-missing values
+    cnt = np.sum(~np.isnan(x), axis=axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avr = np.nansum(x, axis=axis) / cnt
+        var = np.nansum((x - np.expand_dims(avr, axis))**2, axis=axis) / (cnt - 1)
+    avr[cnt == 0] = np.nan
+    var[cnt < 2] = np.nan
+    return avr, np.sqrt(var), cnt
+
+
+def averages(dset=None, ci=None, n_resamples=10000, seed=0, workers=1):
+    """
+    Means and 95% confidence intervals of all parameters per visit, and
+    of the effect sizes.
+
+    Args:
+        dset (dataset.Dataset, optional): the data. Defaults to the 
+          effect data.
+        ci (str, optional): 'normal' for the intervals 1.96*std/sqrt(n)
+          only. With 'percentile' or 'bca', bootstrap intervals of the
+          effect sizes are added as columns 'Effect 95%CI low' and 
+          'Effect 95%CI high'. Defaults to CI.
+        n_resamples (int, optional): number of bootstrap resamples. 
+          Defaults to 10000.
+        seed (int, optional): seed of the bootstrap. Defaults to 0.
+        workers (int, optional): number of processes for the bootstrap.
+          Defaults to 1.
+    """
+    if ci is None:
+        ci = CI
+
+    # Get all data as a cube
+    if dset is None:
+        dset = dataset.load(dataset.EFFECT_DATA)
+    cube = dset.cube()
+    x, y, rows, cols = _visits(cube)
+    x, y = x[:, cols], y[:, cols]
+
+    # Get mean, sdev and count of all variables and effect sizes
+    with np.errstate(divide='ignore', invalid='ignore'):
+        effect = 100*(y-x)/x
+    avr = {}
+    std = {}
+    cnt = {}
+    for visit, v in zip(['control', 'drug', 'effect'], [x, y, effect]):
+        avr[visit], std[visit], cnt[visit] = _describe(v)
     
     # Calculate 95% CI intervals
     visits = ['control', 'drug']
-    b_avr = around_sig(avr[visits[0]].values, 3)
-    r_avr = around_sig(avr[visits[1]].values, 3)
-    c_avr = around_sig(avr_effect.values, 3)
-    b_err = around_sig(
-        1.96*std[visits[0]].values / np.sqrt(cnt[visits[0]].values), 2)
-    r_err = around_sig(
-        1.96*std[visits[1]].values / np.sqrt(cnt[visits[1]].values), 2)
-    c_err = around_sig(
-        1.96*std_effect.values / np.sqrt(cnt_effect.values), 2)
+    b_avr = calc.around_sig(avr[visits[0]], 3)
+    r_avr = calc.around_sig(avr[visits[1]], 3)
+    c_avr = calc.around_sig(avr['effect'], 3)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b_err = calc.around_sig(
+            1.96*std[visits[0]] / np.sqrt(cnt[visits[0]]), 2)
+        r_err = calc.around_sig(
+            1.96*std[visits[1]] / np.sqrt(cnt[visits[1]]), 2)
+        c_err = calc.around_sig(
+            1.96*std['effect'] / np.sqrt(cnt['effect']), 2)
     
     # Create output array
-    output = pd.DataFrame(index=avr.index)
+    output = pd.DataFrame(index=pd.Index(cube.parameters[cols], name='parameter'))
     output[visits[0] + ' Mean'] = b_avr
     output[visits[0] + ' 95%CI'] = b_err
     output[visits[1] + ' Mean'] = r_avr
@@ -158,66 +191,49 @@ def averages():
     output['Effect' + ' Mean'] = c_avr
     output['Effect' + ' 95%CI'] = c_err
 
+    # Bootstrap confidence intervals of the effect sizes
+    if ci != 'normal':
+        low, high = calc.bootstrap_ci(
+            effect, n_resamples, method=ci, seed=seed, workers=workers)
+        output['Effect' + ' 95%CI low'] = calc.around_sig(low, 3)
+        output['Effect' + ' 95%CI high'] = calc.around_sig(high, 3)
+
     # Save output array
-    file = os.path.join(resultspath, 'averages.csv')
-    output.to_csv(file, na_rep="NaN")
+    store.write(output, 'averages', na_rep="NaN")
 
 
-def t_statistic():
+def t_statistic(dset=None):
 
-    # Concatenate all data
-    file = os.path.join(root, 'build', 'Data', 'all_data_effect.dmr')
-    vals = pydmr.read(file, 'pandas')['pars']
+    # Get all data as a cube
+    if dset is None:
+        dset = dataset.load(dataset.EFFECT_DATA)
+    cube = dset.cube()
 
     # Get data from subjects that completed voth visits
-    data_drug = vals[vals.study=='drug']
-    data_control = vals[(vals.study=='control') & (~vals.subject.isin(['LDS-001','LDS-005']))]
-
-    # Separate visits
-    kwargs = {'columns': 'subject', 'index': 'parameter', 'values': 'value'}
-    data_control = data_control.pivot(**kwargs)
-    data_drug = data_drug.pivot(**kwargs)
+    x, y, rows, cols = _visits(cube, exclude=['LDS-001','LDS-005'])
 
     # Compute t_statistic
-    diff = data_drug - data_control
-    std = diff.std(axis=1)
-    cnt = diff.notna().sum(axis=1)
+    diff = y - x
+    _, std, cnt = _describe(diff)
     norm = std/np.sqrt(cnt)
-    diff = diff.div(norm, axis=0) 
+    diff = cube.to_frame(diff / norm, rows, cols).T
 
     # Save
-    file = os.path.join(resultspath, 't_statistic.csv')
-    diff.to_csv(file, na_rep="NaN")
-
-
-
-# Helper functions
+    store.write(diff, 't_statistic', na_rep="NaN")
 
 
-def _first_digit(x):
-    if np.isnan(x):
-        return x
-    return -int(math.floor(math.log10(abs(x))))
-
-def _round_sig(x, n):
-    # Round to n significant digits
-    if x==0:
-        return x
-    if np.isnan(x):
-        return x
-    return round(x, _first_digit(x) + (n-1))
-    
-def around_sig(x, n):
-    return np.array([_round_sig(v,n) for v in x])
-
 
 def main():
 
-    summarise_visits()
-    effect_size()
-    t_statistic()
-    demographics()
-    averages()
+    # Read the data once and share them between all tables
+    all_data = dataset.load(dataset.ALL_DATA)
+    effect_data = dataset.load(dataset.EFFECT_DATA)
+
+    summarise_visits(all_data)
+    effect_size(effect_data)
+    t_statistic(effect_data)
+    demographics(all_data)
+    averages(effect_data)
     
     
 
@@ -0,0 +1,55 @@
+import importlib
+
+
+class module:
+    """
+    A module that is imported on first use.
+
+    Heavy dependencies (pandas, scipy, matplotlib, pingouin, ...) are
+    bound at module level with e.g. `pd = lazy.module('pandas')`, so that
+    importing a stage is cheap and each run only pays for the
+    dependencies of the steps it actually executes.
+
+    Args:
+        name (str): full name of the module, e.g. 'matplotlib.pyplot'.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def preload(modules):
+    """
+    Import the lazy modules bound at module level in the given modules.
+
+    Dependencies that are not installed are skipped.
+
+    Args:
+        modules (list): modules, e.g. the stages of the pipeline.
+    """
+    for mod in modules:
+        for value in list(vars(mod).values()):
+            if isinstance(value, module):
+                try:
+                    value._load()
+                except ImportError:
+                    pass
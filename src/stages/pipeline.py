@@ -0,0 +1,388 @@
+import os
+import json
+import hashlib
+import inspect
+import types
+import zipfile
+
+from stages import setup, data, desc, stats, cluster, plot, report
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+statefile = os.path.join(root, 'build', '.pipeline.json')
+
+
+# Shorthands for paths relative to the root folder
+def _data(*files):
+    return [os.path.join('build', 'Data', f) for f in files]
+
+def _tables(*files):
+    return [os.path.join('build', 'Tables', f) for f in files]
+
+def _figs(*files):
+    return [os.path.join('build', 'Figs', f) for f in files]
+
+def _store(*names):
+    return [os.path.join('build', 'Store', n + '.feather') for n in names]
+
+def _saved(*names):
+    # Tables saved with store.write() - columnar copy plus csv export
+    return _store(*names) + _tables(*[n + '.csv' for n in names])
+
+def _corr(*names):
+    return [n + s for n in names for s in ['_vals', '_pval', '_padj']]
+
+
+DOWNLOADS = _data(*[filename for _, filename in data.DOWNLOADS])
+ALL_DATA = _data('all_data.dmr.zip')
+EFFECT_DATA = _data('all_data_effect.dmr.zip')
+
+# Cached clustering of the heatmaps
+LINKAGE = [os.path.join('build', 'Store', 'linkage.json')]
+
+CORR_CONTROL = _corr('corr_control', 'corr_aorta_control', 'corr_blood_control', 'corr_screening')
+CORR_EFFECT = _corr('corr_liver_effect', 'corr_aorta_effect', 'corr_blood_effect')
+
+
+# Stage graph. Each node lists the functions it runs (in order), or
+# the figures of plot.FIGURES it renders, the files it reads and the 
+# files it writes. Functions that modify a file in place are grouped 
+# in a single node. Nodes are listed in a valid execution order.
+NODES = [
+    {
+        'run': [data.download],
+        'inputs': [os.path.join('_static', 'MRI_metadata.dmr.zip')],
+        'outputs': DOWNLOADS,
+    },
+    {
+        'run': [data.all_data],
+        'inputs': DOWNLOADS,
+        'outputs': ALL_DATA,
+    },
+    {
+        'run': [data.select_response_markers],
+        'inputs': ALL_DATA,
+        'outputs': EFFECT_DATA,
+    },
+    {
+        'run': [desc.summarise_visits],
+        'inputs': ALL_DATA,
+        'outputs': _saved('vals', 'vals_screening', 'vals_control', 'vals_drug'),
+    },
+    {
+        'run': [desc.effect_size],
+        'inputs': EFFECT_DATA,
+        'outputs': _saved('effect_size_absolute', 'effect_size_relative'),
+    },
+    {
+        'run': [desc.t_statistic],
+        'inputs': EFFECT_DATA,
+        'outputs': _saved('t_statistic'),
+    },
+    {
+        'run': [desc.demographics],
+        'inputs': ALL_DATA,
+        'outputs': _tables('table_demographics.csv'),
+    },
+    {
+        'run': [desc.averages],
+        'inputs': EFFECT_DATA,
+        'outputs': _saved('averages'),
+    },
+    {
+        'run': [stats.lft_between_visits],
+        'inputs': ALL_DATA,
+        'outputs': _tables('table_lft_between_visits.csv'),
+    },
+    {
+        'run': [stats.ttest],
+        'inputs': EFFECT_DATA,
+        'outputs': _saved('ttest'),
+    },
+    {
+        'run': [stats.univariate],
+        'inputs': ALL_DATA + _store('averages', 'ttest'),
+        'outputs': _saved('table_liver_univariate', 'table_aorta_univariate'),
+    },
+    {
+        'run': [stats.correlations_control],
+        'inputs': ALL_DATA + _store('vals_control', 'vals_screening'),
+        'outputs': _saved(*CORR_CONTROL),
+    },
+    {
+        'run': [stats.correlations_effect],
+        'inputs': ALL_DATA + _store('effect_size_absolute'),
+        'outputs': _saved(*CORR_EFFECT),
+    },
+    {
+        'run': [stats.sensitivity],
+        'inputs': EFFECT_DATA,
+        'outputs': _saved('sensitivity', 'sensitivity_corr'),
+    },
+    {
+        'run': [cluster.main],
+        'inputs': _store(
+            *[n + '_vals' for n in [*cluster.PANELS, *sum(cluster.PANELS.values(), [])]],
+            'effect_size_absolute', 'vals_control', 'vals_screening',
+        ),
+        'outputs': LINKAGE,
+    },
+    {
+        'figures': ['primary_outcomes'],
+        'inputs': ALL_DATA + _store(
+            'effect_size_relative', 'effect_size_absolute',
+            'vals_control', 'vals_drug',
+        ),
+        'outputs': _figs('primary_outcomes.png'),
+    },
+    {
+        'figures': ['secondary_outcomes'],
+        'inputs': ALL_DATA + _store('table_liver_univariate', 't_statistic'),
+        'outputs': _figs('secondary_outcomes.png'),
+    },
+    {
+        'figures': plot.CONTROL_PANELS,
+        'inputs': ALL_DATA + _store(*CORR_CONTROL) + LINKAGE,
+        'outputs': _figs(*[panel + '.png' for panel in plot.CONTROL_PANELS]),
+    },
+    {
+        'figures': plot.EFFECT_PANELS,
+        'inputs': ALL_DATA + _store(*CORR_EFFECT) + LINKAGE,
+        'outputs': _figs(*[panel + '.png' for panel in plot.EFFECT_PANELS]),
+    },
+    {
+        'figures': ['correlations_control'],
+        'inputs': ALL_DATA + _store(*CORR_CONTROL) + LINKAGE,
+        'outputs': _figs('correlations_control.png'),
+    },
+    {
+        'figures': ['correlations_effect'],
+        'inputs': ALL_DATA + _store(*CORR_EFFECT) + LINKAGE,
+        'outputs': _figs('correlations_effect.png'),
+    },
+    {
+        'figures': ['clustering'],
+        'inputs': ALL_DATA + _store('effect_size_absolute', 'vals_control', 'vals_screening') + LINKAGE,
+        'outputs': _figs('clustering.png'),
+    },
+    {
+        'figures': ['subject_lines'],
+        'inputs': ALL_DATA,
+        'outputs': _figs('subject_lines.png'),
+    },
+    {
+        'figures': ['biomarker_atlas'],
+        'inputs': EFFECT_DATA,
+        'outputs': _figs('biomarker_atlas.pdf'),
+    },
+    {
+        'run': [report.main],
+        'inputs': _figs(
+            'primary_outcomes.png', 'secondary_outcomes.png',
+            'correlations_control.png', 'correlations_effect.png', 'clustering.png',
+        ) + _tables(
+            'table_demographics.csv', 'table_lft_between_visits.csv',
+            'table_liver_univariate.csv', 'table_aorta_univariate.csv',
+        ),
+        'outputs': [os.path.join('build', 'Report.pdf')],
+    },
+]
+
+
+def name(node):
+    if 'figures' in node:
+        return ' + '.join(f"plot.{f}" for f in node['figures'])
+    return ' + '.join(f"{f.__module__.split('.')[-1]}.{f.__name__}" for f in node['run'])
+
+
+def stage(node):
+    if 'figures' in node:
+        return 'plot'
+    return node['run'][0].__module__.split('.')[-1]
+
+
+def file_hash(file):
+    """
+    Hash of the contents of a file. For zip archives only the member
+    names and checksums are used, so rewriting an archive with
+    identical contents leaves the hash unchanged.
+    """
+    h = hashlib.sha256()
+    if zipfile.is_zipfile(file):
+        with zipfile.ZipFile(file) as z:
+            for info in sorted(z.infolist(), key=lambda i: i.filename):
+                h.update(f"{info.filename}:{info.CRC}:{info.file_size};".encode())
+    else:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def code_hash(node):
+    """
+    Hash of the source code of the node's functions, including the
+    functions, classes and constants of the stages package they use.
+    For figures the entry in plot.FIGURES is hashed, with the function
+    and its arguments.
+    """
+    h = hashlib.sha256()
+    seen = set()
+    for func in node.get('run', []):
+        _hash_object(func, h, seen)
+    for figure in node.get('figures', []):
+        _hash_object(plot.FIGURES[figure], h, seen)
+    return h.hexdigest()
+
+
+def _hash_object(obj, h, seen):
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, (types.FunctionType, type)):
+        if not obj.__module__.startswith('stages'):
+            return
+        h.update(inspect.getsource(obj).encode())
+        if isinstance(obj, type):
+            return
+        names = sorted(_code_names(obj.__code__))
+        for n in names:
+            if n not in obj.__globals__:
+                continue
+            ref = obj.__globals__[n]
+            if _is_path(n, ref):
+                continue
+            if n.startswith('_') and isinstance(ref, dict):
+                # Private dicts are runtime caches, e.g. dataset._cache
+                continue
+            if isinstance(ref, types.ModuleType):
+                # Attributes accessed on other stages, e.g. data.lookup_vals
+                if ref.__name__.startswith('stages'):
+                    for m in names:
+                        if hasattr(ref, m) and not _is_path(m, getattr(ref, m)):
+                            _hash_object(getattr(ref, m), h, seen)
+            else:
+                _hash_object(ref, h, seen)
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            h.update(repr(key).encode())
+            _hash_object(value, h, seen)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            _hash_object(value, h, seen)
+    elif isinstance(obj, (set, frozenset)):
+        h.update(repr(sorted(obj, key=repr)).encode())
+    elif isinstance(obj, (str, int, float)):
+        h.update(repr(obj).encode())
+
+
+# Module-level strings that hold paths. These depend on where the code
+# and cache live rather than on what it computes, so they are not 
+# hashed. All other strings, e.g. stats.PADJUST, are.
+PATHS = {'root', 'statefile', 'cachepath', 'ALL_DATA', 'EFFECT_DATA'}
+
+
+def _is_path(name, value):
+    return isinstance(value, str) and (name in PATHS or name.endswith('path'))
+
+
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+
+def _read_state():
+    if not os.path.exists(statefile):
+        return {}
+    with open(statefile, 'r') as f:
+        return json.load(f)
+
+
+def _write_state(state):
+    with open(statefile, 'w') as f:
+        json.dump(state, f, indent=2)
+
+
+def stale(node, state):
+    """
+    Return the reason why a node needs to run, or None if it is up to date.
+    """
+    record = state.get(name(node))
+    if record is None:
+        return 'never run'
+    if record['code'] != code_hash(node):
+        return 'code changed'
+    for file in node['outputs']:
+        if not os.path.exists(os.path.join(root, file)):
+            return f'{file} missing'
+    for file in node['inputs']:
+        path = os.path.join(root, file)
+        if not os.path.exists(path):
+            return f'{file} missing'
+        if record['inputs'].get(file) != file_hash(path):
+            return f'{file} changed'
+    return None
+
+
+def _record(node, state):
+    # Record the state after running, so that in-place
+    # modifications of inputs are not seen as changes.
+    state[name(node)] = {
+        'code': code_hash(node),
+        'inputs': {
+            file: file_hash(os.path.join(root, file))
+            for file in node['inputs']
+        },
+        'outputs': node['outputs'],
+    }
+    _write_state(state)
+
+
+def _render(nodes, state, workers=None):
+    # Render the figures of all nodes together, in parallel processes
+    if not nodes:
+        return
+    plot.render(sum([node['figures'] for node in nodes], []), workers)
+    for node in nodes:
+        _record(node, state)
+
+
+def run(stages=None, force=False, workers=None):
+    """
+    Run all nodes that are out of date.
+
+    Out-of-date figures are collected and rendered together by 
+    plot.render, so that independent figures run in parallel.
+
+    Args:
+        stages (list, optional): only consider nodes of these stages,
+          e.g. ['desc', 'stats']. Defaults to all stages.
+        force (bool, optional): If True, run all nodes regardless of
+          their state. Defaults to False.
+        workers (int, optional): number of processes to render the 
+          figures. Defaults to the number of cores.
+    """
+    setup.build()
+    state = _read_state()
+    figures = []
+    for node in NODES:
+        if stages is not None and stage(node) not in stages:
+            continue
+        # Figures must exist before a later node checks its inputs
+        if 'figures' not in node:
+            _render(figures, state, workers)
+            figures = []
+        reason = 'forced' if force else stale(node, state)
+        if reason is None:
+            print(f"Up to date: {name(node)}")
+            continue
+        print(f"Running: {name(node)} ({reason})")
+        if 'figures' in node:
+            figures.append(node)
+            continue
+        for func in node['run']:
+            func()
+        _record(node, state)
+    _render(figures, state, workers)
@@ -1,13 +1,18 @@
 import os
-import pandas as pd
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colorbar import Colorbar
-import seaborn as sns
-import matplotlib.image as mpimg
-import pydmr
 
-from stages import data
+from stages import lazy, data, dataset, cluster, store
+
+pd = lazy.module('pandas')
+matplotlib = lazy.module('matplotlib')
+plt = lazy.module('matplotlib.pyplot')
+mcolorbar = lazy.module('matplotlib.colorbar')
+mfigure = lazy.module('matplotlib.figure')
+backend_pdf = lazy.module('matplotlib.backends.backend_pdf')
+sns = lazy.module('seaborn')
 
 root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 
@@ -51,8 +56,7 @@ clr = {
 def _tstat_box_plots(ax):
 
     sig = 0.01
-    file = os.path.join(tablespath, 'table_liver_univariate.csv')
-    univ = pd.read_csv(file).set_index('parameter')
+    univ = store.read('table_liver_univariate')
     univ['group'] = data.lookup_vals(univ.index.values, 'group')
     univ['cluster'] = data.lookup_vals(univ.index.values, 'cluster')
     univ['label'] = data.lookup_vals(univ.index.values, 'label')
@@ -62,8 +66,7 @@ def _tstat_box_plots(ax):
     cluster = univ['cluster'].values
     lbl = univ['label'].values
     
-    file = os.path.join(tablespath, 't_statistic.csv')
-    tstat = pd.read_csv(file).set_index('parameter')
+    tstat = store.read('t_statistic')
 
     vals = [tstat.loc[p,:].dropna().values for p in pars]
 
@@ -114,55 +117,105 @@ def _tstat_box_plots(ax):
 
 
 
-def _subject_line_plot(ax, par):
+def _visit_pairs(cube, par):
+
+    # Control and drug values (2 x subjects) of the subjects with both
+    # visits, and the index of each among the subjects with a control
+    # visit, in the order of the source file, which sets their marker 
+    # and color.
+    p = cube.parameters.get_loc(par)
+    c, d = cube.study('control'), cube.study('drug')
+    control = np.flatnonzero(cube.present[:, p, c])
+    control = control[np.argsort(cube.row[control, p, c], kind='stable')]
+    i = np.flatnonzero(cube.present[control, p, d])
+    s = control[i]
+    return cube.values[s, p][:, [c, d]].T, i, cube.subjects[s]
+
+
+def _subject_line_plot(ax, par, dset=None, markersize=6, linewidth=2.0):
 
     # Setup plot
     fontsize=10
-    markersize=6
-    linewidth=2.0
     #ax.set_title(lbl, fontsize=14, pad=10)
     #ax.set_ylabel(lbl, fontsize=fontsize)
     #ax.set_ylim(0, ylim[0])
     ax.tick_params(axis='x', labelcolor='none')
     ax.tick_params(axis='y', labelcolor='none')
 
-    # Concatenate all data
-    file = os.path.join(root, 'build', 'Data', 'all_data.dmr')
-    vals = pydmr.read(file, 'pandas')['pars']
+    # Get the data for this parameter
+    if dset is None:
+        dset = dataset.load(dataset.ALL_DATA)
+    y, i, subjects = _visit_pairs(dset.cube(), par)
 
     for axis in ['top','bottom','left','right']:
         ax.spines[axis].set_linewidth(linewidth)
 
-    vals = vals[vals.parameter==par]
-    data_control = vals[vals.study=='control']
-    data_drug = vals[vals.study=='drug']
-
-    for i, subj in enumerate(data_control.subject):
-        x = ['1']
-        y = [data_control[data_control.subject==subj].value.values[0]] 
-        if subj in data_drug.subject.values:
-            x += ['2']
-            y += [
-                data_drug[data_drug.subject==subj].value.values[0]
-            ]
-            ax.plot(x, y, '-', label=subj, marker=mark[i], 
-                    markersize=markersize, color=clr[i])
+    # All subjects in one call, with markers and colors from the cycle
+    if len(i) > 0:
+        ax.set_prop_cycle(
+            color=[clr[k % len(clr)] for k in i], 
+            marker=[mark[k % len(mark)] for k in i],
+        )
+        ax.plot(['1', '2'], y, linestyle='-', label=list(subjects), markersize=markersize)
+
+
+def subject_line_atlas(pars=None, ncols=10, filename='subject_lines'):
+    """
+    Subject line plots of all parameters with control and drug values,
+    in one figure.
+
+    Args:
+        pars (list, optional): parameters to plot. Defaults to all 
+          parameters with values at both visits, sorted by cluster.
+        ncols (int, optional): number of panels per row. Defaults to 10.
+        filename (str, optional): name of the figure in build/Figs.
+    """
+    dset = dataset.load(dataset.ALL_DATA)
+    if pars is None:
+        cube = dset.cube()
+        c, d = cube.study('control'), cube.study('drug')
+        both = (cube.present[:, :, c] & cube.present[:, :, d]).any(axis=0)
+        pars = pd.Series(data.lookup_vals(cube.parameters[both], 'cluster'), 
+                         index=cube.parameters[both])
+        pars = pars.sort_values(kind='stable').index
+    pars = list(pars)
+    nrows = int(np.ceil(len(pars) / ncols))
+
+    # Fixed layout and no ticks - tick labels are hidden anyway, and 
+    # laying out ticks dominates the time for many panels
+    fig = plt.figure(figsize=(2*ncols, 2*nrows))
+    axes = fig.subplots(nrows, ncols, squeeze=False, 
+        gridspec_kw={'hspace': 0.3, 'wspace': 0.1, 'left': 0.01, 'right': 0.99,
+                     'bottom': 0.2/nrows, 'top': 1 - 0.3/nrows},
+    ).ravel()
+    labels = data.lookup_vals(pars, 'label')
+    for ax, par, lbl in zip(axes, pars, labels):
+        _subject_line_plot(ax, par, dset, markersize=3, linewidth=1.0)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        ax.set_title(lbl or par, fontsize=10)
+    for ax in axes[len(pars):]:
+        ax.set_axis_off()
+
+    figfile = os.path.join(resultspath, filename + '.png')
+    plt.savefig(fname=figfile)
+    plt.close()
         
 
 def _subject_line_plots(fig):
 
     sig = 0.01
-    file = os.path.join(tablespath, 'table_liver_univariate.csv')
-    univ = pd.read_csv(file).set_index('parameter')
+    univ = store.read('table_liver_univariate')
     univ['group'] = data.lookup_vals(univ.index.values, 'group')
     univ['cluster'] = data.lookup_vals(univ.index.values, 'cluster')
     univ = univ.sort_values(by='cluster')
     univ = univ[univ['p-value'] < sig]
     pars = univ.index.values
 
+    dset = dataset.load(dataset.ALL_DATA)
     axes = fig.subplots(1, pars.size)
     for i, ax in enumerate(axes.ravel()):
-        _subject_line_plot(ax, pars[i])
+        _subject_line_plot(ax, pars[i], dset)
 
 
 
@@ -194,8 +247,7 @@ def secondary_outcomes():
 
 def primary_outcomes_box_plot_rel(ax):
 
-    file = os.path.join(tablespath, 'effect_size_relative.csv')
-    effect = pd.read_csv(file, index_col=0)
+    effect = store.read('effect_size_relative')
 
     lbls = ['k(he)', 'k(bh)']
     data = [
@@ -243,8 +295,7 @@ def primary_outcomes_box_plot_rel(ax):
 
 def primary_outcomes_box_plot_abs(ax):
 
-    file = os.path.join(tablespath, 'effect_size_absolute.csv')
-    effect = pd.read_csv(file, index_col=0) 
+    effect = store.read('effect_size_absolute')
 
     #pars = effect.parameter.unique()
     lbls = ['k(he)', '10 x k(bh)']
@@ -295,11 +346,8 @@ def primary_outcomes_line_plot(ax, par):
 
     lbl = data.lookup_vals([par], 'label')[0]
 
-    file = os.path.join(tablespath, 'vals_control.csv')
-    vals_control = pd.read_csv(file).set_index('parameter')
-
-    file = os.path.join(tablespath, 'vals_drug.csv')
-    vals_drug = pd.read_csv(file).set_index('parameter')
+    vals_control = store.read('vals_control')
+    vals_drug = store.read('vals_drug')
 
     # file = os.path.join(tablespath, 'stdev_control.csv')
     # stdev_control = pd.read_csv(file).set_index('parameter')
@@ -330,8 +378,8 @@ def primary_outcomes_line_plot(ax, par):
             #x = [i + 2*nsubj]
             y += [yrif]
             #yerr += [stdev_drug.at[par, subj]]
-        ax.plot(x, y, '-', label=subj, marker=mark[i], 
-                markersize=markersize, color=clr[i], 
+        ax.plot(x, y, '-', label=subj, marker=mark[i % len(mark)], 
+                markersize=markersize, color=clr[i % len(clr)], 
                 linewidth=linewidth, 
         )
         #ax.errorbar(x, y, yerr=yerr, fmt='o', capsize=5)
@@ -367,381 +415,487 @@ def primary_outcomes():
 
 
 
-def correlation_effect_clustermap(filename, cols=None, xfigsize=16, pos=[0,0,1,1], title=''):
-
-    file = os.path.join(tablespath, filename + '_vals.csv')
-    vals = pd.read_csv(file).set_index('X')
-    file = os.path.join(tablespath, filename + '_pval.csv')
-    pval = pd.read_csv(file).set_index('X')
-
-    #vals = np.abs(vals)
-    #vmin, center, vmax = 0, 0.5, 1.0
-    #cmap = 'cool'
-    vmin, center, vmax = -1, 0, 1.0
-    cmap = 'coolwarm'
-
-    fontsize = 24 
-    
-    sig = 0.05
-    #sig = 1
-    mask = pval>sig
-    #mask = vals<0.5
-    significant = pval<sig
-
-    select = False
-
-    if select:
-        #accept = (pval<sig) & (vals != 1)
-        accept = pval<sig
-        # accept_rows = accept.any(axis=0)
-        # vals = vals.loc[:,accept_rows]
-        # pval = pval.loc[:,accept_rows]
-        # mask = mask.loc[:,accept_rows]
-        # accept = accept.loc[:,accept_rows]
-        
-        accept_cols = accept.any(axis=1)
-        vals = vals.loc[accept_cols,:]
-        pval = pval.loc[accept_cols,:]
-        mask = mask.loc[accept_cols,:]
-        accept = accept.loc[accept_cols,:]
-        significant = significant.loc[accept_cols,:]
-
-    if cols is None:
-        row_cluster = True
-    else:
-        row_cluster = False
-        c = [c for c in cols if c in vals.columns]
-        vals = vals[c]
-        mask = mask[c]
-        significant = significant[c]
- 
-    g = sns.clustermap(vals.T, 
+# Area of the asterisks marking significant cells, in points^2
+SIG_MARKERSIZE = 300
+
+
+def heatmap(fig, vals, pval=None, xorder=None, yorder=None, pos=[0,0,1,1], title='', 
+            colorbar=False, yticklabels=True, sig=0.05, vmin=-1, center=0, vmax=1.0, 
+            cmap='coolwarm', fontsize=24):
+    """
+    Draw a correlation matrix as a heatmap in a figure or subfigure.
+
+    Args:
+        fig (Figure or SubFigure): where to draw.
+        vals (pd.DataFrame): correlation coefficients, with the 
+          parameters on the columns of the heatmap (X) as index and 
+          those on the rows (Y) as columns, as saved by the stats stage.
+        pval (pd.DataFrame, optional): p-values in the same format. 
+          Cells with p < sig are marked with an asterisk.
+        xorder (list, optional): order of the columns. Defaults to the 
+          order in vals.
+        yorder (list, optional): order of the rows. Defaults to the 
+          order in vals.
+        pos (list, optional): position of the axes [left, bottom, 
+          width, height] in figure coordinates.
+        title (str, optional): title of the figure.
+        colorbar (bool, optional): add a colorbar on the left. 
+        yticklabels (bool, optional): label the rows on the right.
+        sig (float, optional): significance level. Defaults to 0.05.
+        vmin, center, vmax, cmap, fontsize: style of the heatmap.
+
+    Returns:
+        Axes: the axes of the heatmap.
+    """
+    xpar = list(vals.index) if xorder is None else list(xorder)
+    ypar = list(vals.columns) if yorder is None else list(yorder)
+    vals = vals.T.loc[ypar, xpar]
+
+    ax = fig.add_axes(pos)
+    sns.heatmap(vals, ax=ax,
         center=center, vmin=vmin, vmax=vmax, cmap=cmap,
-        #dendrogram_ratio=(.1, .2),
-        cbar_pos=None,
+        cbar=False,
         linewidths=0.5, 
         linecolor='black',
-        figsize=(xfigsize, 15), 
         yticklabels=True, 
         xticklabels=True,
-        #mask=mask.T,
-        row_cluster=row_cluster,
-        col_cluster=True,
     )
-    g.fig.suptitle(title, fontsize=32, y=0.95)
-    g.ax_row_dendrogram.remove()
-    g.ax_col_dendrogram.remove()
-    #g.ax_heatmap.set_frame_on(True)
-    g.ax_heatmap.set_position(pos)
+    ax.yaxis.set_ticks_position('right')
+    fig.suptitle(title, fontsize=32, y=0.95)
+
     # Format labels
     linewidth = 2.0
-    for ax in [g.ax_heatmap, g.ax_row_dendrogram, g.ax_col_dendrogram]:
-        for spine in ax.spines.values():
-            spine.set_visible(True) 
-            spine.set_edgecolor('black')
-            spine.set_linewidth(linewidth)  
-    xpar = g.ax_heatmap.get_xmajorticklabels()
-    ypar = g.ax_heatmap.get_ymajorticklabels()
-    xpar = [p._text for p in xpar]
-    ypar = [p._text for p in ypar]
+    for spine in ax.spines.values():
+        spine.set_visible(True) 
+        spine.set_edgecolor('black')
+        spine.set_linewidth(linewidth)  
     xlbl = data.lookup_vals(xpar, 'label')
     ylbl = data.lookup_vals(ypar, 'label')
-    g.ax_heatmap.set_xticklabels(xlbl, rotation=90, fontsize=fontsize)
-    g.ax_heatmap.set_yticklabels(ylbl, rotation=0, fontsize=fontsize)
-    g.ax_heatmap.set_ylabel('')
-    g.ax_heatmap.set_xlabel('')
-
-    # Add asterix in significant cells
-
-    # Get the reordered indices
-    #x_labels = g.data2d.columns
-    #y_labels = g.data2d.index
-    x_labels = xpar
-    y_labels = ypar
-
-    # Loop over the heatmap and add asterisk where significant
-    for y in range(len(y_labels)):
-        for x in range(len(x_labels)):
-            if significant.loc[x_labels[x], y_labels[y]]:
-                g.ax_heatmap.text(
-                    x + 0.5, y + 0.5, '*',
-                    ha='center', va='center', color='black',
-                    fontsize=36,
-                )
+    ax.set_xticklabels(xlbl, rotation=90, fontsize=fontsize)
+    ax.set_yticklabels(ylbl, rotation=0, fontsize=fontsize)
+    ax.set_ylabel('')
+    ax.set_xlabel('')
+
+    # Add asterix in significant cells, all in one collection
+    if pval is not None:
+        y, x = np.nonzero((pval < sig).loc[xpar, ypar].values.T)
+        ax.scatter(x + 0.5, y + 0.5, marker='$*$', s=SIG_MARKERSIZE, 
+                   color='black', linewidths=0)
 
     # Create the colorbar
-    if filename == 'corr_liver_effect':
+    if colorbar:
         # Define the colorbar axis position: [left, bottom, width, height]
-        cbar_ax = g.fig.add_axes([.05, .25, .03, .5])
-        Colorbar(cbar_ax, g.ax_heatmap.collections[0], orientation='vertical')
-        #g.ax_cbar.set_position((.1, .25, .03, .4))
+        cbar_ax = fig.add_axes([.05, .25, .03, .5])
+        mcolorbar.Colorbar(cbar_ax, ax.collections[0], orientation='vertical')
         cbar_ax.tick_params(labelsize=20)
         # Set the number of major ticks
         cbar_ax.locator_params(nbins=10) # Set number of major tick marks
 
-    #plt.subplots_adjust(left=0.0, right=0.8, bottom=0.2)
-    if cols is not None:
-        g.ax_heatmap.set_yticklabels([])
+    if not yticklabels:
+        ax.set_yticklabels([])
 
-    file = os.path.join(resultspath, filename + '.png')
-    plt.savefig(fname=file)
-    plt.close()
+    return ax
 
+
+def _correlation_panel(fig, filename, cols=None, pos=[0,0,1,1], title='', colorbar=False, 
+                       adjusted=False, matrices=None):
+
+    # Draws a correlation panel and returns the order of the columns. 
+    # The rows are the liver parameters and are clustered, unless an 
+    # order is provided by cols. The matrices (r, p, corrected p) are 
+    # read from the store unless they are provided. Cells are marked as significant 
+    # by the uncorrected p-values, or by the p-values corrected for 
+    # multiple testing if adjusted=True.
+    if matrices is None:
+        vals = store.read(filename + '_vals')
+        pval = store.read(filename + ('_padj' if adjusted else '_pval'))
+    else:
+        vals, pval, padj = matrices
+        if adjusted:
+            pval = padj
+    ypar, xpar = cluster.heatmap_order(vals, cols)
+    heatmap(fig, vals, pval, xpar, ypar, pos, title, colorbar, 
+            yticklabels = cols is None)
     return xpar
 
 
-def correlations_effect():
+def correlation_clustermap(filename, cols=None, xfigsize=16, pos=[0,0,1,1], title='',
+                           colorbar=False, adjusted=False, matrices=None, fig=None):
+    """
+    Save a correlation panel as a standalone figure in build/Figs.
+
+    Args:
+        filename (str): name of the correlation block, e.g. 'corr_control'.
+        cols (list, optional): order of the liver parameters. If not 
+          provided they are clustered.
+        xfigsize (float, optional): width of the figure in inches.
+        pos (list, optional): position of the heatmap in the figure.
+        title (str, optional): title of the panel.
+        colorbar (bool, optional): add a colorbar. Defaults to False.
+        adjusted (bool, optional): mark significance by the p-values
+          corrected for multiple testing. Defaults to False.
+        matrices (tuple, optional): correlation coefficients, p-values
+          and corrected p-values, if they are not to be read from the 
+          store.
+        fig (Figure, optional): figure to draw in, cleared first. 
+          Defaults to a new figure.
+
+    Returns:
+        list: the order of the columns.
+    """
+    if fig is None:
+        fig = plt.figure(figsize=(xfigsize, 15))
+        close = True
+    else:
+        fig.clear()
+        fig.set_size_inches(xfigsize, 15)
+        close = False
+    xpar = _correlation_panel(fig, filename, cols, pos, title, colorbar, adjusted, matrices)
+    file = os.path.join(resultspath, filename + '.png')
+    fig.savefig(fname=file)
+    if close:
+        plt.close(fig)
+    return xpar
 
-    pars = correlation_effect_clustermap('corr_liver_effect', title='Liver', xfigsize=16, pos=[0.15, 0.15, 0.7, 0.75]) # [left, bottom, width, height]
-    correlation_effect_clustermap('corr_aorta_effect', title='Aorta', cols=pars, xfigsize=6, pos=[0.05, 0.15, 0.90, 0.75])
-    correlation_effect_clustermap('corr_blood_effect', title='LFT', cols=pars, xfigsize=6, pos=[0.05, 0.15, 0.90, 0.75])
 
-    fig = plt.figure(figsize=(28, 15))
-    subfigs = fig.subfigures(1, 3, wspace=0.0, width_ratios=[1.9, 0.7, 0.7])
-    
-    img0 = mpimg.imread(os.path.join(resultspath, 'corr_liver_effect.png'))
-    ax = subfigs[0].subplots(1,1)
-    ax.imshow(img0)
-    ax.axis('off')
-    img1 = mpimg.imread(os.path.join(resultspath, 'corr_aorta_effect.png'))
-    ax = subfigs[2].subplots(1,1)
-    ax.imshow(img1)
-    ax.axis('off')
-    img2 = mpimg.imread(os.path.join(resultspath, 'corr_blood_effect.png'))
-    ax = subfigs[1].subplots(1,1)
-    ax.imshow(img2)
-    ax.axis('off')
+def correlation_panels(names, matrices=None, adjusted=False):
+    """
+    Save many correlation panels as standalone figures, reusing a 
+    single figure and canvas.
+
+    Args:
+        names (list): panels in FIGURES, e.g. CONTROL_PANELS. A panel 
+          that uses the order of another panel must come after it.
+        matrices (dict, optional): (r, p, corrected p) per panel, e.g. 
+          as returned by stats.correlations_effect(). Panels not 
+          included are read from the store.
+        adjusted (bool, optional): mark significance by the p-values
+          corrected for multiple testing. Defaults to False.
+
+    Returns:
+        dict: the order of the columns per panel.
+    """
+    if matrices is None:
+        matrices = {}
+    fig = plt.figure()
+    orders = {}
+    for name in names:
+        deps = {k: orders[d] for k, d in FIGURES[name].get('deps', {}).items()}
+        orders[name] = correlation_clustermap(
+            **FIGURES[name]['kwargs'], **deps, adjusted=adjusted, 
+            matrices=matrices.get(name), fig=fig,
+        )
+    plt.close(fig)
+    return orders
+
+
+def correlations_effect(formats=None, adjusted=False, matrices=None):
+    """
+    Save the composite figure of the correlations between effect sizes.
+
+    Args:
+        formats (list, optional): file formats, e.g. ['png', 'pdf']. 
+          Defaults to ['png'].
+        adjusted (bool, optional): mark significance by the p-values
+          corrected for multiple testing. Defaults to False.
+        matrices (dict, optional): (r, p, corrected p) per panel, as 
+          returned by stats.correlations_effect(), to plot without 
+          reading them back. Panels not included, and all panels in 
+          the pipeline, are read from the store.
+    """
+    _correlations_figure('correlations_effect', EFFECT_PANELS, [1.9, 0.7, 0.7], 
+                         formats, adjusted, matrices)
+
+
+def correlations_control(formats=None, adjusted=False, matrices=None):
+    """
+    Save the composite figure of the correlations at control.
+
+    Args:
+        formats (list, optional): file formats, e.g. ['png', 'pdf']. 
+          Defaults to ['png'].
+        adjusted (bool, optional): mark significance by the p-values
+          corrected for multiple testing. Defaults to False.
+        matrices (dict, optional): (r, p, corrected p) per panel, as 
+          returned by stats.correlations_control(), to plot without 
+          reading them back. Panels not included, and all panels in 
+          the pipeline, are read from the store.
+    """
+    _correlations_figure('correlations_control', CONTROL_PANELS, [1.85, 0.7, 0.7, 0.7], 
+                         formats, adjusted, matrices)
+
+
+def _correlations_figure(filename, panels, width_ratios, formats=None, adjusted=False, matrices=None):
+
+    # Draw the panels side by side in one figure with the relative 
+    # widths of width_ratios. Each panel is scaled vertically as the 
+    # standalone figure would be when fitted to its width, and centered.
+    # The first (liver) panel sets the order of the liver parameters 
+    # in the others. The figure is saved in each of formats, by default
+    # as png.
+    if formats is None:
+        formats = ['png']
+    if matrices is None:
+        matrices = {}
+    layout = [FIGURES[panel]['kwargs'] for panel in panels]
+    xfigsize, yfigsize = 28, 15
+    fig = plt.figure(figsize=(xfigsize, yfigsize))
+    subfigs = fig.subfigures(1, len(panels), wspace=0.0, width_ratios=width_ratios)
+    cols = None
+    for subfig, panel, kwargs, ratio in zip(subfigs, panels, layout, width_ratios):
+        scale = min(1, xfigsize*ratio/sum(width_ratios)/kwargs['xfigsize'])
+        subfig = subfig.subfigures(3, 1, height_ratios=[1-scale, 2*scale, 1-scale])[1]
+        xpar = _correlation_panel(subfig, kwargs['filename'], cols, 
+            kwargs['pos'], kwargs['title'], colorbar = cols is None,
+            adjusted = adjusted, matrices = matrices.get(panel),
+        )
+        if cols is None:
+            cols = xpar
 
-    # Save
-    figfile = os.path.join(resultspath, 'correlations_effect.png')
-    plt.tight_layout()
-    plt.savefig(fname=figfile)
+    # Save in each format, e.g. ['png', 'pdf', 'svg']
+    for fmt in formats:
+        figfile = os.path.join(resultspath, filename + '.' + fmt)
+        plt.savefig(fname=figfile)
     plt.close()
 
 
-def correlation_control_clustermap(filename, cols=None, xfigsize=16, pos=[0,0,1,1], title=''):
+def clustering():
 
-    file = os.path.join(tablespath, filename + '_vals.csv')
-    vals = pd.read_csv(file).set_index('X')
-    file = os.path.join(tablespath, filename + '_pval.csv')
-    pval = pd.read_csv(file).set_index('X')
+    vals = cluster.clustering_matrix()
+    row_linkage, _ = cluster.linkage(vals)
+    col_linkage, _ = cluster.linkage(vals.T)
 
-    #vals = np.abs(vals)
-    #vmin, center, vmax = 0, 0.5, 1.0
-    #cmap = 'cool'
-    vmin, center, vmax = -1, 0, 1.0
-    cmap='coolwarm'
+    vmin, center, vmax = -2.5, 0, 2.5
+    cmap='viridis'
 
     fontsize = 24 
-    
-    sig = 0.05
-    #sig = 1
-    mask = pval>sig
-    #mask = vals<0.5
-    significant = pval<sig
-
-    select = False
-
-    if select:
-        #accept = (pval<sig) & (vals != 1)
-        accept = pval<sig
-        # accept_rows = accept.any(axis=0)
-        # vals = vals.loc[:,accept_rows]
-        # pval = pval.loc[:,accept_rows]
-        # mask = mask.loc[:,accept_rows]
-        # accept = accept.loc[:,accept_rows]
-        
-        accept_cols = accept.any(axis=1)
-        vals = vals.loc[accept_cols,:]
-        pval = pval.loc[accept_cols,:]
-        mask = mask.loc[accept_cols,:]
-        accept = accept.loc[accept_cols,:]
-        significant = significant.loc[accept_cols,:]
-
-    if cols is None:
-        row_cluster = True
-    else:
-        row_cluster = False
-        c = [c for c in cols if c in vals.columns]
-        vals = vals[c]
-        mask = mask[c]
-        significant = significant[c]
- 
-    g = sns.clustermap(vals.T, 
+
+    g = sns.clustermap(vals, 
         center=center, vmin=vmin, vmax=vmax, cmap=cmap,
         #dendrogram_ratio=(.1, .2),
         cbar_pos=None,
         linewidths=0.5, 
         linecolor='black',
-        figsize=(xfigsize, 15), 
+        figsize=(25, 5), 
         yticklabels=True, 
         xticklabels=True,
         #mask=mask.T,
-        row_cluster=row_cluster,
-        col_cluster=True,
+        row_linkage=row_linkage,
+        col_linkage=col_linkage,
     )
-    g.fig.suptitle(title, fontsize=32, y=0.95)
-    g.ax_row_dendrogram.remove()
-    g.ax_col_dendrogram.remove()
-    #g.ax_heatmap.set_frame_on(True)
-    g.ax_heatmap.set_position(pos)
-    # Format labels
-    linewidth = 2.0
-    for ax in [g.ax_heatmap, g.ax_row_dendrogram, g.ax_col_dendrogram]:
-        for spine in ax.spines.values():
-            spine.set_visible(True) 
-            spine.set_edgecolor('black')
-            spine.set_linewidth(linewidth)  
-    xpar = g.ax_heatmap.get_xmajorticklabels()
-    ypar = g.ax_heatmap.get_ymajorticklabels()
-    xpar = [p._text for p in xpar]
-    ypar = [p._text for p in ypar]
-    xlbl = data.lookup_vals(xpar, 'label')
-    ylbl = data.lookup_vals(ypar, 'label')
-    g.ax_heatmap.set_xticklabels(xlbl, rotation=90, fontsize=fontsize)
-    g.ax_heatmap.set_yticklabels(ylbl, rotation=0, fontsize=fontsize)
-    g.ax_heatmap.set_ylabel('')
-    g.ax_heatmap.set_xlabel('')
-
-    # Add asterix in significant cells
-
-    # Get the reordered indices
-    #x_labels = g.data2d.columns
-    #y_labels = g.data2d.index
-    x_labels = xpar
-    y_labels = ypar
-
-    # Loop over the heatmap and add asterisk where significant
-    for y in range(len(y_labels)):
-        for x in range(len(x_labels)):
-            if significant.loc[x_labels[x], y_labels[y]]:
-                g.ax_heatmap.text(
-                    x + 0.5, y + 0.5, '*',
-                    ha='center', va='center', color='black',
-                    fontsize=36,
-                )
-
-    # Create the colorbar
-    if filename == 'corr_control':
-        # Define the colorbar axis position: [left, bottom, width, height]
-        cbar_ax = g.fig.add_axes([.05, .25, .03, .5])
-        Colorbar(cbar_ax, g.ax_heatmap.collections[0], orientation='vertical')
-        #g.ax_cbar.set_position((.1, .25, .03, .4))
-        cbar_ax.tick_params(labelsize=20)
-        # Set the number of major ticks
-        cbar_ax.locator_params(nbins=10) # Set number of major tick marks
-
-    #plt.subplots_adjust(left=0.0, right=0.8, bottom=0.2)
-    if cols is not None:
-        g.ax_heatmap.set_yticklabels([])
 
-    file = os.path.join(resultspath, filename + '.png')
+    file = os.path.join(resultspath, 'clustering.png')
     plt.savefig(fname=file)
     plt.close()
 
-    return xpar
 
+def _atlas_page(pars, nrows, ncols):
+
+    # One A4 page of the biomarker atlas, built without pyplot so that 
+    # it can be returned from a worker process.
+    cube = dataset.load(dataset.EFFECT_DATA).cube()
+    cd = [cube.study('control'), cube.study('drug')]
+    fig = mfigure.Figure(figsize=(8.27, 11.69))
+    axes = fig.subplots(nrows, ncols, squeeze=False, 
+        gridspec_kw={'hspace': 0.6, 'wspace': 0.5, 'left': 0.1, 'right': 0.97,
+                     'bottom': 0.04, 'top': 0.96},
+    ).ravel()
+    names = data.lookup_vals(pars, 'label')
+    units = data.lookup_vals(pars, 'unit')
+    for ax, par, name, unit in zip(axes, pars, names, units):
+        p = cube.parameters.get_loc(par)
+        present = cube.present[:, p, cd]
+        s = np.flatnonzero(present.any(axis=1))
+        y = np.where(present[s], cube.values[s, p][:, cd], np.nan).T
+        err = np.where(present[s], cube.sdev[s, p][:, cd], np.nan).T
+
+        # All subjects in one call each for the lines and error bars
+        x = np.array([0, 1])
+        ax.set_prop_cycle(
+            color=[clr[k % len(clr)] for k in range(len(s))], 
+            marker=[mark[k % len(mark)] for k in range(len(s))],
+        )
+        ax.plot(x, y, linestyle='-', markersize=3, linewidth=1.0)
+        ax.errorbar(np.repeat(x, len(s)), y.ravel(), yerr=err.ravel(), 
+                    fmt='none', ecolor='black', elinewidth=0.5, capsize=2)
+        ax.set_xticks(x, ['control', 'drug'], fontsize=7)
+        ax.set_xlim(-0.3, 1.3)
+        ax.tick_params(axis='y', labelsize=6)
+        ax.set_title(f"{name or par} ({unit})" if unit else (name or par), fontsize=8)
+    for ax in axes[len(pars):]:
+        ax.set_axis_off()
+    return fig
+
+
+def biomarker_atlas(filename='biomarker_atlas', nrows=5, ncols=4, workers=None):
+    """
+    Control and drug values of each subject for all biomarkers of the 
+    effect data, with error bars from their standard deviations, in a 
+    multi-page PDF.
+
+    Pages are built in parallel processes and written to the PDF as 
+    soon as they are ready, in order. At most a few pages per process 
+    are held in memory at any time.
+
+    Args:
+        filename (str, optional): name of the PDF in build/Figs.
+        nrows (int, optional): rows of panels per page. Defaults to 5.
+        ncols (int, optional): columns of panels per page. Defaults to 4.
+        workers (int, optional): number of processes. Defaults to the 
+          number of cores, or to 1 in a worker process, e.g. of render.
+          With workers=1 the pages are built in the current process.
+    """
+    cube = dataset.load(dataset.EFFECT_DATA).cube()
+    pars = pd.Series(data.lookup_vals(cube.parameters, 'cluster'), index=cube.parameters)
+    pars = list(pars.sort_values(kind='stable').index)
+    size = nrows * ncols
+    # An empty page if there are no biomarkers, so that the file exists
+    pages = [pars[i:i+size] for i in range(0, len(pars), size)] or [[]]
+    if workers is None:
+        # Do not start a pool inside another pool's worker
+        if multiprocessing.parent_process() is not None:
+            workers = 1
+        else:
+            workers = os.cpu_count() or 1
+    workers = min(workers, len(pages))
+
+    figfile = os.path.join(resultspath, filename + '.pdf')
+    with backend_pdf.PdfPages(figfile) as pdf:
+        if workers <= 1:
+            for page in pages:
+                pdf.savefig(_atlas_page(page, nrows, ncols))
+            return
+        with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+            # Keep a bounded window of pages in flight
+            running = []
+            for page in pages:
+                running.append(pool.submit(_atlas_page, page, nrows, ncols))
+                if len(running) >= 2*workers:
+                    pdf.savefig(running.pop(0).result())
+            for future in running:
+                pdf.savefig(future.result())
+
+
+# Figures and the figures they depend on. A dependency is passed to 
+# the figure function as a keyword argument, e.g. the aorta panels use 
+# the column order of the liver panel (cols). Figures marked parallel
+# start their own processes and take the number as argument workers.
+LIVER_PANEL = {'xfigsize': 16, 'pos': [0.15, 0.15, 0.7, 0.75]} # [left, bottom, width, height]
+SIDE_PANEL = {'xfigsize': 6, 'pos': [0.05, 0.15, 0.90, 0.75]}
+
+CONTROL_PANELS = ['corr_control'] + cluster.PANELS['corr_control']
+EFFECT_PANELS = ['corr_liver_effect'] + cluster.PANELS['corr_liver_effect']
+
+FIGURES = {
+    'primary_outcomes': {'run': primary_outcomes},
+    'secondary_outcomes': {'run': secondary_outcomes},
+    'corr_control': {
+        'run': correlation_clustermap,
+        'kwargs': {'filename': 'corr_control', 'title': 'Liver', 'colorbar': True, **LIVER_PANEL},
+    },
+    'corr_aorta_control': {
+        'run': correlation_clustermap,
+        'kwargs': {'filename': 'corr_aorta_control', 'title': 'Aorta', **SIDE_PANEL},
+        'deps': {'cols': 'corr_control'},
+    },
+    'corr_blood_control': {
+        'run': correlation_clustermap,
+        'kwargs': {'filename': 'corr_blood_control', 'title': 'LFT', **SIDE_PANEL},
+        'deps': {'cols': 'corr_control'},
+    },
+    'corr_screening': {
+        'run': correlation_clustermap,
+        'kwargs': {'filename': 'corr_screening', 'title': 'Screening', **SIDE_PANEL},
+        'deps': {'cols': 'corr_control'},
+    },
+    'correlations_control': {'run': correlations_control},
+    'corr_liver_effect': {
+        'run': correlation_clustermap,
+        'kwargs': {'filename': 'corr_liver_effect', 'title': 'Liver', 'colorbar': True, **LIVER_PANEL},
+    },
+    'corr_aorta_effect': {
+        'run': correlation_clustermap,
+        'kwargs': {'filename': 'corr_aorta_effect', 'title': 'Aorta', **SIDE_PANEL},
+        'deps': {'cols': 'corr_liver_effect'},
+    },
+    'corr_blood_effect': {
+        'run': correlation_clustermap,
+        'kwargs': {'filename': 'corr_blood_effect', 'title': 'LFT', **SIDE_PANEL},
+        'deps': {'cols': 'corr_liver_effect'},
+    },
+    'correlations_effect': {'run': correlations_effect},
+    'clustering': {'run': clustering},
+    'subject_lines': {'run': subject_line_atlas},
+    'biomarker_atlas': {'run': biomarker_atlas, 'parallel': True},
+}
 
-def correlations_control():
 
-    pars = correlation_control_clustermap('corr_control', title='Liver', xfigsize=16, pos=[0.15, 0.15, 0.7, 0.75]) # [left, bottom, width, height]
-    correlation_control_clustermap('corr_aorta_control', title='Aorta', cols=pars, xfigsize=6, pos=[0.05, 0.15, 0.90, 0.75])
-    correlation_control_clustermap('corr_blood_control', title='LFT', cols=pars, xfigsize=6, pos=[0.05, 0.15, 0.90, 0.75])
-    correlation_control_clustermap('corr_screening', title='Screening', cols=pars, xfigsize=6, pos=[0.05, 0.15, 0.90, 0.75])
+def _render_figure(name, **results):
+    fig = FIGURES[name]
+    return fig['run'](**fig.get('kwargs', {}), **results)
 
-    fig = plt.figure(figsize=(28, 15))
-    subfigs = fig.subfigures(1, 4, wspace=0.0, width_ratios=[1.85, 0.7, 0.7, 0.7])
-    
-    img0 = mpimg.imread(os.path.join(resultspath, 'corr_control.png'))
-    ax = subfigs[0].subplots(1,1)
-    ax.imshow(img0)
-    ax.axis('off')
-    img1 = mpimg.imread(os.path.join(resultspath, 'corr_aorta_control.png'))
-    ax = subfigs[2].subplots(1,1)
-    ax.imshow(img1)
-    ax.axis('off')
-    img2 = mpimg.imread(os.path.join(resultspath, 'corr_blood_control.png'))
-    ax = subfigs[1].subplots(1,1)
-    ax.imshow(img2)
-    ax.axis('off')
-    img3 = mpimg.imread(os.path.join(resultspath, 'corr_screening.png'))
-    ax = subfigs[3].subplots(1,1)
-    ax.imshow(img3)
-    ax.axis('off')
 
-    # Save
-    figfile = os.path.join(resultspath, 'correlations_control.png')
-    plt.tight_layout()
-    plt.savefig(fname=figfile)
-    plt.close()
+def _init_worker():
+    matplotlib.use('Agg')
 
 
-def clustering():
+def render(names=None, workers=None):
+    """
+    Render figures in parallel processes.
 
-    file = os.path.join(tablespath, 'effect_size_absolute.csv')
-    vals = pd.read_csv(file, index_col=0)
-    vals = (vals - vals.mean())/vals.std(ddof=0)
-    vals = vals.dropna(axis=1, how='any')
-    vars = set(vals.columns) - set(data.EXCLUDE_EFFECT)
-    vals = vals[list(vars)]
-    vals = vals.rename(lambda x: 'Delta ' + data.lookup_vals(x, 'label'), axis=1)
-    vals.index = [str(i) for i in vals.index]
-
-    file = os.path.join(tablespath, 'vals_control.csv')
-    vals0 = pd.read_csv(file).set_index('parameter').T
-    vals0 = (vals0 - vals0.mean())/vals0.std(ddof=0)
-    vals0 = vals0.dropna(axis=1, how='any')
-    vars0 = set(vals0.columns) - set(data.EXCLUDE_EFFECT)
-    vals0 = vals0[list(vars0)]
-    vals0 = vals0.rename(lambda x: data.lookup_vals(x, 'label'), axis=1)
-    vals0 = vals0.loc[vals.index]
-
-    vals = pd.concat([vals0, vals], axis=1)
-
-    file = os.path.join(tablespath, 'vals_screening.csv')
-    vals0 = pd.read_csv(file).set_index('parameter').T
-    vals0 = (vals0 - vals0.mean())/vals0.std(ddof=0)
-    vals0 = vals0.dropna(axis=1, how='any')
-    vars0 = set(vals0.columns) - set(data.EXCLUDE_EFFECT)
-    vals0 = vals0[list(vars0)]
-    vals0 = vals0.rename(lambda x: data.lookup_vals(x, 'label'), axis=1)
-    vals0 = vals0.loc[vals.index]
-
-    vals = pd.concat([vals0, vals], axis=1)
+    Each figure starts as soon as the figures it depends on are done.
+    Figures that start their own processes, such as the biomarker 
+    atlas, are rendered after the others in the current process, with 
+    all workers.
 
-    vmin, center, vmax = -2.5, 0, 2.5
-    cmap='viridis'
+    Args:
+        names (list, optional): figures to render. Their dependencies 
+          are rendered too. Defaults to all figures.
+        workers (int, optional): number of processes. Defaults to the 
+          number of cores. With workers=1 the figures are rendered in 
+          the current process.
 
-    fontsize = 24 
+    Returns:
+        dict: the return values of the figure functions.
+    """
+    # Add dependencies of the requested figures
+    todo = list(FIGURES) if names is None else list(names)
+    for name in todo:
+        todo += [d for d in FIGURES[name].get('deps', {}).values() if d not in todo]
+    todo = [name for name in FIGURES if name in todo]
+    deps = lambda name: FIGURES[name].get('deps', {})
 
-    g = sns.clustermap(vals, 
-        center=center, vmin=vmin, vmax=vmax, cmap=cmap,
-        #dendrogram_ratio=(.1, .2),
-        cbar_pos=None,
-        linewidths=0.5, 
-        linecolor='black',
-        figsize=(25, 5), 
-        yticklabels=True, 
-        xticklabels=True,
-        #mask=mask.T,
-        # row_cluster=row_cluster,
-        # col_cluster=True,
-    )
+    parallel = [name for name in todo if FIGURES[name].get('parallel')]
+    todo = [name for name in todo if name not in parallel]
 
-    file = os.path.join(resultspath, 'clustering.png')
-    plt.savefig(fname=file)
-    plt.close()
+    done = {}
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if min(workers, len(todo)) <= 1:
+        for name in todo:
+            done[name] = _render_figure(name, **{k: done[d] for k, d in deps(name).items()})
+    else:
+        running = {}
+        with ProcessPoolExecutor(min(workers, len(todo)), initializer=_init_worker) as pool:
+            while todo or running:
+                for name in [n for n in todo if all(d in done for d in deps(n).values())]:
+                    results = {k: done[d] for k, d in deps(name).items()}
+                    running[pool.submit(_render_figure, name, **results)] = name
+                    todo.remove(name)
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done[running.pop(future)] = future.result()
 
+    for name in parallel:
+        results = {k: done[d] for k, d in deps(name).items()}
+        done[name] = _render_figure(name, workers=workers, **results)
+    return done
 
-def main():
 
-    primary_outcomes()
-    secondary_outcomes()
-    correlations_control()
-    correlations_effect()
-    clustering()
+def main(workers=None):
+
+    render(workers=workers)
 
 
 if __name__=='__main__':
     main()
-
@@ -1,5 +1,8 @@
 import os
-import miblab
+
+from stages import lazy
+
+miblab = lazy.module('miblab')
 
 root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 
@@ -11,11 +11,13 @@ def build():
     data_dir = os.path.join(build, 'Data')
     tables_dir = os.path.join(build, 'Tables')
     figures_dir = os.path.join(build, 'Figs')
+    store_dir = os.path.join(build, 'Store')
 
     # Creat clean directories
     os.makedirs(data_dir, exist_ok=True)
     os.makedirs(tables_dir, exist_ok=True)  
     os.makedirs(figures_dir, exist_ok=True)
+    os.makedirs(store_dir, exist_ok=True)
 
     return data_dir, tables_dir, figures_dir
 
@@ -2,31 +2,34 @@ import os
 
 
 import numpy as np
-import pandas as pd
-import pingouin as pg
-import pydmr
 
-from stages import data
+from stages import lazy, data, dataset, calc, store
+
+pd = lazy.module('pandas')
+pg = lazy.module('pingouin')
 
 root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 
 resultspath = os.path.join(root, 'build', 'Tables')
 
+# Correction for multiple testing: 'holm', 'fdr_bh' or 'fdr_by'
+PADJUST = 'fdr_bh'
+
 
 
-def lft_between_visits():
+def lft_between_visits(dset=None):
 
-    file = os.path.join(root, 'build', 'Data', 'all_data.dmr')
+    if dset is None:
+        dset = dataset.load(dataset.ALL_DATA)
+    cube = dset.cube()
 
     # Values at the start of the drug visit before administering the drug
     init = ['InitALP', 'InitALT', 'InitAlb', 'InitBili', 'InitConBili', 'InitConTotBili']
-    dmr = pydmr.read(file, 'pandas', study='drug', parameter=init)
-    df1 = dmr['pars'].pivot(columns='parameter', index='subject', values='value')
+    df1 = cube.frame('drug', parameters=init)
 
     # Values before the control scan
     init = ['PreALP', 'PreALT', 'PreAlb', 'PreBili', 'PreConBili', 'PreConTotBili']
-    dmr = pydmr.read(file, 'pandas', study='control', parameter=init)
-    df0 = dmr['pars'].pivot(columns='parameter', index='subject', values='value')
+    df0 = cube.frame('control', parameters=init)
 
     # Extract only baseline cases with follow-ups
     df0 = df0.loc[df1.index]
@@ -49,19 +52,19 @@ def lft_between_visits():
     df0 = df0.describe().T
     avr = np.around(df0['mean'].values, 1)
     ci = np.around(1.96*df0['std'].values, 1)
-    col1 = [f"{avr[i]} ({ci[i]})" for i in range(avr.size)]
+    col1 = calc.format_ci(avr, ci)
 
     # Build average and confidence intervals (drug visit)
     df1 = df1.describe().T
     avr = np.around(df1['mean'].values, 1)
     ci = np.around(1.96*df1['std'].values, 1)
-    col2 = [f"{avr[i]} ({ci[i]})" for i in range(avr.size)] 
+    col2 = calc.format_ci(avr, ci)
 
     # Build average and confidence intervals (difference)
     diff = diff.describe().T
     avr = np.around(diff['mean'].values, 1)
     ci = np.around(1.96*diff['std'].values, 1)
-    col3 = [f"{avr[i]} ({ci[i]})" for i in range(avr.size)]  
+    col3 = calc.format_ci(avr, ci)
 
     # Save results as csv
     file = os.path.join(resultspath, 'table_lft_between_visits.csv')
@@ -75,14 +78,65 @@ def lft_between_visits():
     table.to_csv(file)
 
 
-def ttest():
+def ttest(dset=None, check=False):
+    """
+    Paired t-tests between visits for all parameters at once, with
+    p-values of exact sign-flip permutation tests in column 'p-perm'.
+    P-values corrected for multiple testing over all parameters are in 
+    column 'p-corr', with the method (PADJUST) in column 'p-adjust'.
+
+    Args:
+        dset (dataset.Dataset, optional): response markers. If not 
+          provided they are loaded from all_data_effect.dmr.
+        check (bool, optional): If True, the results are checked against 
+          pingouin.pairwise_tests and a ValueError is raised if they 
+          differ. Defaults to False.
+    """
     
     # Concatenate all data
-    file = os.path.join(root, 'build', 'Data', 'all_data_effect.dmr')
-    vals = pydmr.read(file, 'pandas')['pars']
+    if dset is None:
+        dset = dataset.load(dataset.EFFECT_DATA)
+    vals = dset.values()
+
+    # Subjects x parameters for each visit
+    A, B = np.sort(vals.study.unique())
+    wide = vals.pivot(index='subject', columns=['study', 'parameter'], values='value')
+    pars = np.sort(vals.parameter.unique())
+    x = wide[A].reindex(columns=pars)
+    y = wide[B].reindex(columns=pars)
+
+    # Perform t-tests and sign-flip permutation tests, and build the 
+    # pingouin output format
+    stats = calc.paired_ttest(x, y)
+    output = pd.DataFrame({
+        'Contrast': 'study',
+        'A': A,
+        'B': B,
+        'Paired': True,
+        'Parametric': True,
+        'T': stats['T'].values,
+        'dof': stats['dof'].values,
+        'alternative': 'two-sided',
+        'p-unc': stats['p-unc'].values,
+        'p-corr': calc.adjust_p(stats['p-unc'].values, PADJUST),
+        'p-adjust': PADJUST,
+        'p-perm': calc.permutation_ttest(x, y),
+        'BF10': calc.format_bf(stats['BF10'].values),
+        'odds-ratio': stats['odds-ratio'].values,
+        'parameter': pars,
+    })
+
+    if check:
+        _ttest_check(output, _ttest_pingouin(vals))
+
+    # Save results
+    store.write(output, 'ttest', index=False, na_rep="NaN")
+
+
+def _ttest_pingouin(vals):
 
-    # Perform t-tests and save if df output
-    output = None
+    # Reference implementation - one pingouin call per parameter
+    output = []
     for par in np.sort(vals.parameter.unique()):
         data_par = vals[vals.parameter==par]
         stats = pg.pairwise_tests(
@@ -91,24 +145,35 @@ def ttest():
                 return_desc=False, effsize='odds-ratio',
         )
         stats['parameter'] = par
-        if output is None:
-            output = stats
-        else:
-            output = pd.concat([output, stats])
-
-    # Save results
-    file = os.path.join(resultspath, 'ttest.csv')
-    output.to_csv(file, index=False, na_rep="NaN")
+        output.append(stats)
+    return pd.concat(output, ignore_index=True)
+
+
+def _ttest_check(output, reference, rtol=1e-6):
+
+    errors = []
+    for col in ['T', 'dof', 'p-unc', 'BF10', 'odds-ratio']:
+        # BF10 is formatted to 3 decimals so compare those more loosely
+        tol = 1e-2 if col == 'BF10' else rtol
+        v = output[col].values.astype(float)
+        r = reference[col].values.astype(float)
+        diff = ~np.isclose(v, r, rtol=tol, atol=0, equal_nan=True)
+        if diff.any():
+            errors.append(f"{col}: {list(output.parameter.values[diff])}")
+    if errors:
+        raise ValueError(
+            "Batched t-tests differ from pingouin.pairwise_tests for "
+            + "; ".join(errors)
+        )
 
 
 def univariate():
     
     # Sort table with averages
-    avrgs = pd.read_csv(os.path.join(resultspath, 'averages.csv'))
-    avrgs = avrgs.set_index('parameter') 
+    avrgs = store.read('averages')
 
     # Sort t-test table and drop uninformative columns
-    stats = pd.read_csv(os.path.join(resultspath, 'ttest.csv')) 
+    stats = store.read('ttest')
     stats = stats.set_index('parameter') 
     cols = ['Contrast', 'A', 'B', 'Paired', 'Parametric', 'dof', 'alternative']
     stats = stats.drop(columns=cols) 
@@ -119,19 +184,12 @@ def univariate():
     # Rename columns
     output.rename(columns={"p-unc": "p-value"}, inplace=True)
     
-    b_avr = output['control Mean'].values
-    b_err = output['control 95%CI'].values
-    r_avr = output['drug Mean'].values
-    r_err = output['drug 95%CI'].values
-    c_avr = output['Effect Mean'].values
-    c_err = output['Effect 95%CI'].values
-
-    output['control'] = [
-        f'{b_avr[i]} ({b_err[i]}) ' for i in range(b_avr.size)]
-    output['drug'] = [
-        f'{r_avr[i]} ({r_err[i]}) ' for i in range(r_avr.size)]
-    output['Effect size (%)'] = [
-        f'{c_avr[i]} ({c_err[i]}) ' for i in range(c_avr.size)]
+    output['control'] = calc.format_ci(
+        output['control Mean'], output['control 95%CI'], suffix=' ')
+    output['drug'] = calc.format_ci(
+        output['drug Mean'], output['drug 95%CI'], suffix=' ')
+    output['Effect size (%)'] = calc.format_ci(
+        output['Effect Mean'], output['Effect 95%CI'], suffix=' ')
     
     # Lookup group, units and add as column
     unit = data.lookup_vals(output.index.values, 'unit')
@@ -143,111 +201,178 @@ def univariate():
     output = output.sort_values(by=['Group', 'p-value'])
     output.loc[:,'T'] = np.around(output['T'].values, 1)
     output.loc[:,'p-value'] = np.around(output['p-value'].values, 3)
+    output.loc[:,'p-perm'] = np.around(output['p-perm'].values, 3)
     
     # Retain most informative columns
     output = output[
         ['Name', 'Group', 'control', 'drug', 
-         'Effect size (%)', 'T', "p-value"]
+         'Effect size (%)', 'T', "p-value", "p-perm"]
     ]
     
     # Split up for aorta and liver, rename groups and save to csv.
     output_liver = output[output.Group != 'MRI - aorta']
     output_liver = output_liver.replace({'Blood - liver function test': 'LFT', 'MRI - liver': 'MRI'})
-    output_liver.to_csv(os.path.join(resultspath, 'table_liver_univariate.csv'))
+    store.write(output_liver, 'table_liver_univariate')
 
     output_aorta = output[output.Group == 'MRI - aorta']
     output_aorta = output_aorta.replace({'MRI - aorta': 'MRI'})
-    output_aorta.to_csv(os.path.join(resultspath, 'table_aorta_univariate.csv'))
+    store.write(output_aorta, 'table_aorta_univariate')
 
 
 def correlations_control():
     
-    file = os.path.join(resultspath, 'vals_control.csv')
-    vals_control = pd.read_csv(file).set_index('parameter')
-    file = os.path.join(resultspath, 'vals_screening.csv')
-    vals_screening = pd.read_csv(file).set_index('parameter')
+    vals_control = store.read('vals_control')
+    vals_screening = store.read('vals_screening')
     vals = pd.concat([vals_control, vals_screening]).T
-
-    corr = []
-    vars = set(vals.columns) - set(data.EXCLUDE_EFFECT)
-    for X in vars:
-        for Y in vars:
-            x = vals[X].values
-            y = vals[Y].values
-            c = pg.corr(x,y)
-            c['X'] = X
-            c['Y'] = Y
-            corr.append(c)
-    corr = pd.concat(corr)
-    corr.rename(columns={'p-val':'p-unc'}, inplace=True)
-
-    correlations_control_submatrix(corr, 'MRI - liver', 'corr_control')
-    correlations_control_submatrix(corr, 'MRI - aorta', 'corr_aorta_control')
-    correlations_control_submatrix(corr, 'Blood - liver function test', 'corr_blood_control')
-    correlations_control_submatrix(corr, 'Screening', 'corr_screening')
+    vals = vals.drop(columns=data.EXCLUDE_EFFECT, errors='ignore')
+
+    # Return the matrices so they can be plotted without reading them back
+    return {
+        'corr_control': correlations_control_submatrix(vals, 'MRI - liver', 'corr_control'),
+        'corr_aorta_control': correlations_control_submatrix(vals, 'MRI - aorta', 'corr_aorta_control'),
+        'corr_blood_control': correlations_control_submatrix(vals, 'Blood - liver function test', 'corr_blood_control'),
+        'corr_screening': correlations_control_submatrix(vals, 'Screening', 'corr_screening'),
+    }
 
 
-def correlations_control_submatrix(corr, X, filename):
+def correlations_control_submatrix(vals, X, filename):
 
     Y = 'MRI - liver'
 
     # select parameters
-    xpars = data.lookup_params('group', X)
-    ypars = data.lookup_params('group', Y)
-    corr = corr[(corr.X.isin(xpars)) & (corr.Y.isin(ypars))]
+    xpars = sorted(set(data.lookup_params('group', X)) & set(vals.columns))
+    ypars = sorted(set(data.lookup_params('group', Y)) & set(vals.columns))
 
-    # Pivot to wide format
-    vals = corr.pivot(values='r', index='X', columns='Y')
-    file = os.path.join(resultspath, filename + '_vals.csv')
-    vals.to_csv(file, na_rep="NaN")
+    # Compute the X-Y block only
+    corr = calc.corr(vals[xpars], vals[ypars])
 
-    pval = corr.pivot(values='p-unc', index='X', columns='Y')
-    file = os.path.join(resultspath, filename + '_pval.csv')
-    pval.to_csv(file, na_rep="NaN")
+    store.write(corr['r'], filename + '_vals', na_rep="NaN")
+    store.write(corr['p-unc'], filename + '_pval', na_rep="NaN")
+    padj = _write_padj(corr['p-unc'], filename)
+    return corr['r'], corr['p-unc'], padj
 
 
-def correlations_effect():
+def _write_padj(pval, filename):
 
-    file = os.path.join(resultspath, 'effect_size_absolute.csv')
-    effect = pd.read_csv(file, index_col=0)
-    #corr = pg.pairwise_corr(effect)
-    corr = []
-    vars = set(effect.columns)
-    for X in vars:
-        for Y in vars:
-            x = effect[X].values
-            y = effect[Y].values
-            c = pg.corr(x,y)
-            c['X'] = X
-            c['Y'] = Y
-            corr.append(c)
-    corr = pd.concat(corr)
-    corr.rename(columns={'p-val':'p-unc'}, inplace=True)
-
-    correlations_effect_submatrix(corr, 'MRI - liver', 'corr_liver_effect')
-    correlations_effect_submatrix(corr, 'MRI - aorta', 'corr_aorta_effect')
-    correlations_effect_submatrix(corr, 'Blood - liver function test', 'corr_blood_effect')
-
-
-def correlations_effect_submatrix(corr, X, filename):
+    # Corrected p-values of a block, with the unique pairs as family 
+    # if the block correlates a group with itself
+    symmetric = list(pval.index) == list(pval.columns)
+    padj = calc.adjust_p(pval.values, PADJUST, symmetric=symmetric)
+    padj = pd.DataFrame(padj, index=pval.index, columns=pval.columns)
+    store.write(padj, filename + '_padj', na_rep="NaN")
+    return padj
 
-    Y = 'MRI - liver'
 
-    # select parameters
-    xpars = data.lookup_params('group', X)
-    ypars = data.lookup_params('group', Y)
-    corr = corr[(corr.X.isin(xpars)) & (corr.Y.isin(ypars))]
+def correlations_effect():
 
-    # Pivot to wide format
-    vals = corr.pivot(values='r', index='X', columns='Y')
-    file = os.path.join(resultspath, filename + '_vals.csv')
-    vals.to_csv(file, na_rep="NaN")
+    effect = store.read('effect_size_absolute')
+
+    # Return the matrices so they can be plotted without reading them back
+    return {
+        'corr_liver_effect': correlations_effect_submatrix(effect, 'MRI - liver', 'corr_liver_effect'),
+        'corr_aorta_effect': correlations_effect_submatrix(effect, 'MRI - aorta', 'corr_aorta_effect'),
+        'corr_blood_effect': correlations_effect_submatrix(effect, 'Blood - liver function test', 'corr_blood_effect'),
+    }
 
-    pval = corr.pivot(values='p-unc', index='X', columns='Y')
-    file = os.path.join(resultspath, filename + '_pval.csv')
-    pval.to_csv(file, na_rep="NaN")
 
+def correlations_effect_submatrix(effect, X, filename):
 
+    Y = 'MRI - liver'
+
+    # select parameters
+    xpars = sorted(set(data.lookup_params('group', X)) & set(effect.columns))
+    ypars = sorted(set(data.lookup_params('group', Y)) & set(effect.columns))
+
+    # Compute the X-Y block only
+    corr = calc.corr(effect[xpars], effect[ypars])
+
+    store.write(corr['r'], filename + '_vals', na_rep="NaN")
+    store.write(corr['p-unc'], filename + '_pval', na_rep="NaN")
+    padj = _write_padj(corr['p-unc'], filename)
+    return corr['r'], corr['p-unc'], padj
+
+
+def sensitivity(dset=None, k=1, sig=0.05):
+    """
+    Sensitivity of the results to individual subjects.
+
+    The averages and t-tests of the effect sizes, and the correlations
+    between effect sizes, are recomputed for every subset of k subjects
+    left out. Saves a table 'sensitivity' with the range of the results
+    per parameter, and a table 'sensitivity_corr' with the range of the
+    correlations per pair of parameters.
+
+    Args:
+        dset (dataset.Dataset, optional): response markers. If not 
+          provided they are loaded from all_data_effect.dmr.
+        k (int, optional): number of subjects left out. Defaults to 1.
+        sig (float, optional): significance level. Defaults to 0.05.
+    """
+    if dset is None:
+        dset = dataset.load(dataset.EFFECT_DATA)
+    cube = dset.cube()
+
+    # Subjects x parameters with both visits
+    c, d = cube.study('control'), cube.study('drug')
+    x = np.where(cube.present[:, :, c], cube.values[:, :, c], np.nan)
+    y = np.where(cube.present[:, :, d], cube.values[:, :, d], np.nan)
+    paired = ~np.isnan(y - x)
+    rows, cols = paired.any(axis=1), paired.any(axis=0)
+    x = np.where(paired, x, np.nan)[rows][:, cols]
+    y = np.where(paired, y, np.nan)[rows][:, cols]
+    subjects = cube.subjects[rows]
+    pars = cube.parameters[cols]
+
+    # All subsets, with the full data as first subset
+    L = calc.leave_out(len(subjects), k)
+    L = np.vstack([np.zeros(len(subjects)), L])
+    left_out = ['; '.join(subjects[l > 0]) for l in L[1:]]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        effect = 100*(y-x)/x
+    avr, _, _ = calc.leave_out_describe(effect, L)
+    T, p = calc.leave_out_ttest(x, y, L)
+    with np.errstate(invalid='ignore'):
+        worst = np.nanargmax(np.where(np.isnan(p[1:]), -1, p[1:]), axis=0)
+
+    output = pd.DataFrame({
+        'Effect Mean': calc.around_sig(avr[0], 3),
+        'Effect Mean min': calc.around_sig(np.nanmin(avr[1:], axis=0), 3),
+        'Effect Mean max': calc.around_sig(np.nanmax(avr[1:], axis=0), 3),
+        'T': np.around(T[0], 1),
+        'T min': np.around(np.nanmin(T[1:], axis=0), 1),
+        'T max': np.around(np.nanmax(T[1:], axis=0), 1),
+        'p-value': np.around(p[0], 3),
+        'p-value max': np.around(np.nanmax(p[1:], axis=0), 3),
+        'Significant (%)': np.around(100*np.mean(p[1:] < sig, axis=0), 1),
+        'Most influential': np.array(left_out)[worst],
+    }, index=pd.Index(pars, name='parameter'))
+    store.write(output, 'sensitivity', na_rep="NaN")
+
+    # Correlations between effect sizes, as in correlations_effect
+    effect = pd.DataFrame(y - x, columns=pars)
+    output = []
+    for X, filename in [
+        ('MRI - liver', 'corr_liver_effect'), 
+        ('MRI - aorta', 'corr_aorta_effect'), 
+        ('Blood - liver function test', 'corr_blood_effect'),
+    ]:
+        xpars = sorted(set(data.lookup_params('group', X)) & set(pars))
+        ypars = sorted(set(data.lookup_params('group', 'MRI - liver')) & set(pars))
+        r, p = calc.leave_out_corr(effect[xpars], effect[ypars], L)
+        with np.errstate(invalid='ignore'):
+            block = pd.DataFrame({
+                'r': r[0].ravel(),
+                'r min': np.nanmin(r[1:], axis=0).ravel(),
+                'r max': np.nanmax(r[1:], axis=0).ravel(),
+                'p-value': p[0].ravel(),
+                'p-value max': np.nanmax(p[1:], axis=0).ravel(),
+                'Significant (%)': 100*np.mean(p[1:] < sig, axis=0).ravel(),
+            }, index=pd.MultiIndex.from_product([xpars, ypars], names=['X', 'Y']))
+        block.insert(0, 'block', filename)
+        output.append(block[block.index.get_level_values('X') != block.index.get_level_values('Y')])
+    output = pd.concat(output).round(3)
+    store.write(output, 'sensitivity_corr', na_rep="NaN")
 
 
 
@@ -256,11 +381,12 @@ def correlations_effect_submatrix(corr, X, filename):
 
 def main():
 
-    lft_between_visits()
-    ttest()
+    lft_between_visits(dataset.load(dataset.ALL_DATA))
+    ttest(dataset.load(dataset.EFFECT_DATA))
     univariate()
     correlations_control()
     correlations_effect()
+    sensitivity(dataset.load(dataset.EFFECT_DATA))
     
 
 
@@ -0,0 +1,65 @@
+import os
+
+from stages import lazy
+
+pa = lazy.module('pyarrow')
+feather = lazy.module('pyarrow.feather')
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+storepath = os.path.join(root, 'build', 'Store')
+tablespath = os.path.join(root, 'build', 'Tables')
+
+
+def path(name):
+    return os.path.join(storepath, name + '.feather')
+
+
+def write_feather(table, file):
+    """
+    Save an Arrow table as uncompressed feather file, atomically.
+
+    The table is written to a temporary file in the same folder and 
+    then moved onto file, so that other processes never read a partly
+    written file, and files that are memory-mapped elsewhere are 
+    replaced rather than modified.
+    """
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    tmp = f"{file}.{os.getpid()}.tmp"
+    try:
+        feather.write_feather(table, tmp, compression='uncompressed')
+        os.replace(tmp, file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def write(df, name, csv=True, **kwargs):
+    """
+    Save a table for use by later stages.
+
+    The table is saved in Arrow (feather) format, with column types and
+    the (multi-)index preserved. It is not compressed, so that it can be
+    memory-mapped when it is read. Unless csv=False, the table is also
+    exported to build/Tables as a csv file for publication.
+
+    Args:
+        df (pd.DataFrame): table to save.
+        name (str): name of the table, without extension.
+        csv (bool, optional): also export to csv. Defaults to True.
+        kwargs: keyword arguments for DataFrame.to_csv.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    write_feather(table, path(name))
+    if csv:
+        df.to_csv(os.path.join(tablespath, name + '.csv'), **kwargs)
+
+
+def read(name):
+    """
+    Read a table saved with write().
+
+    The file is memory-mapped, so columns without missing values are
+    not copied when they are converted to pandas.
+    """
+    table = feather.read_table(path(name), memory_map=True)
+    return table.to_pandas(split_blocks=True)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The stages package lives in src, as when running src/run.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'src'))
@@ -0,0 +1,63 @@
+import zipfile
+
+import pydmr
+
+from stages import data
+
+
+def _dmr(value=1.5):
+    return {
+        'data': {
+            'khe': ['Hepatocellular uptake rate', 'mL/min/100cm3', 'float'],
+            'kbh': ['Biliary excretion rate', 'mL/min/100cm3', 'float'],
+        },
+        'pars': {
+            ('001', 'control', 'khe'): value,
+            ('001', 'control', 'kbh'): 0.25,
+            ('002', 'drug', 'khe'): 0.75,
+        },
+        'sdev': {
+            ('001', 'control', 'khe'): 0.1,
+        },
+    }
+
+
+def _members(file):
+    with zipfile.ZipFile(file) as z:
+        assert z.testzip() is None
+        return {i.filename: z.read(i.filename) for i in z.infolist()}
+
+
+def test_write_skips_unchanged_archive(tmp_path):
+    file = str(tmp_path / 'test.dmr')
+    assert data.write(file, _dmr())
+    assert not data.write(file, _dmr())
+
+
+def test_write_reuses_unchanged_members(tmp_path):
+    file = str(tmp_path / 'test.dmr')
+    data.write(file, _dmr())
+    with zipfile.ZipFile(file + '.zip') as z:
+        before = data._read_raw(file + '.zip', z.infolist())
+
+    # Only pars.csv changes
+    assert data.write(file, _dmr(value=2.5))
+    with zipfile.ZipFile(file + '.zip') as z:
+        after = data._read_raw(file + '.zip', z.infolist())
+    assert after['data.csv'][1] == before['data.csv'][1]
+    assert after['sdev.csv'][1] == before['sdev.csv'][1]
+    assert after['pars.csv'][1] != before['pars.csv'][1]
+
+    # Same contents as an archive written from scratch
+    data.write(str(tmp_path / 'fresh.dmr'), _dmr(value=2.5), reuse=False)
+    assert _members(file + '.zip') == _members(str(tmp_path / 'fresh.dmr.zip'))
+    assert pydmr.read(file)['pars'][('001', 'control', 'khe')] == 2.5
+
+
+def test_write_without_zipfile_internals(tmp_path, monkeypatch):
+    file = str(tmp_path / 'test.dmr')
+    data.write(file, _dmr())
+    monkeypatch.setattr(data, '_can_write_raw', lambda z: False)
+    assert data.write(file, _dmr(value=2.5))
+    data.write(str(tmp_path / 'fresh.dmr'), _dmr(value=2.5), reuse=False)
+    assert _members(file + '.zip') == _members(str(tmp_path / 'fresh.dmr.zip'))
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from stages import data, dataset, desc, store
+
+
+@pytest.fixture
+def dset(tmp_path, monkeypatch):
+    # Control and drug visits of 6 subjects for 2 parameters, with the 
+    # index and tables written to a temporary folder
+    monkeypatch.setattr(store, 'storepath', str(tmp_path / 'Store'))
+    monkeypatch.setattr(store, 'tablespath', str(tmp_path))
+    rng = np.random.default_rng(0)
+    pars = {}
+    for par in ['khe', 'kbh']:
+        for i in range(6):
+            control = rng.uniform(10, 20)
+            pars[(f'00{i}', 'control', par)] = control
+            pars[(f'00{i}', 'drug', par)] = control * rng.uniform(0.2, 0.6)
+    file = str(tmp_path / 'test.dmr')
+    data.write(file, {
+        'data': {
+            'khe': ['Hepatocellular uptake rate', 'mL/min/100cm3', 'float'],
+            'kbh': ['Biliary excretion rate', 'mL/min/100cm3', 'float'],
+        },
+        'pars': pars,
+    })
+    return dataset.Dataset(file)
+
+
+def test_averages_bootstrap_ci(dset):
+    assert desc.CI != 'normal'
+    desc.averages(dset, n_resamples=1000)
+    avr = store.read('averages')
+    low, high = avr['Effect 95%CI low'], avr['Effect 95%CI high']
+    assert np.all(low < avr['Effect Mean'])
+    assert np.all(avr['Effect Mean'] < high)
+
+
+def test_averages_normal_ci(dset):
+    desc.averages(dset, ci='normal')
+    avr = store.read('averages')
+    assert 'Effect 95%CI' in avr.columns
+    assert 'Effect 95%CI low' not in avr.columns